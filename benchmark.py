@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks MarkupServe against a synthetic tree of Markdown documents.
+
+The tree is generated from a seed, so runs with the same parameters are
+comparable. Requests are made to MarkupServe's bottle application
+in-process, without going through a server or the network. Results are
+written as JSON.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+WORDS = (
+    "alpha bravo charlie delta echo foxtrot golf hotel india juliet kilo lima "
+    "mike november oscar papa quebec romeo sierra tango uniform victor "
+    "whiskey xray yankee zulu index search render convert directory "
+    "calendar markup document server cache thread process latency budget "
+    "notes meeting research experiment result draft review summary").split()
+
+CODE_BLOCKS = {
+    "python": "def f(x):\n    return [y * 2 for y in range(x)]\n",
+    "c": "int f(int x) {\n    return x * 2;\n}\n",
+    "javascript": "function f(x) {\n  return x.map(y => y * 2);\n}\n",
+    "bash": "for f in *.md; do\n  wc -l \"$f\"\ndone\n"
+    }
+
+CALENDAR_FILE_PREFIX = "Log-"
+
+
+def sentence(rng):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(6, 16))]
+    return " ".join(words).capitalize() + "."
+
+
+def markdown_document(rng, size, code_fraction):
+    """
+    Returns a Markdown document of about size bytes, made of headings,
+    paragraphs and (with probability code_fraction per section) fenced code
+    blocks
+    """
+    sections = []
+    length = 0
+
+    while length < size:
+        section = "## %s\n\n%s\n\n" % (
+            sentence(rng), " ".join(sentence(rng) for _ in range(5)))
+
+        if rng.random() < code_fraction:
+            language = rng.choice(sorted(CODE_BLOCKS))
+            section += "```%s\n%s```\n\n" % (language, CODE_BLOCKS[language])
+
+        sections.append(section)
+        length += len(section)
+
+    return "# %s\n\n%s" % (sentence(rng), "".join(sections))
+
+
+def generate_tree(root, args):
+    """
+    Writes a tree of args.files documents, args.depth directories deep with
+    args.fanout subdirectories per directory, to root. Returns the paths of
+    the documents, directories and calendar directories, relative to root.
+    """
+    rng = random.Random(args.seed)
+
+    directories = [""]
+    level = [""]
+
+    for depth in range(args.depth):
+        level = [os.path.join(parent, "dir%d-%d" % (depth, i))
+                 for parent in level for i in range(args.fanout)]
+        directories.extend(level)
+
+    calendar_directories = set(rng.sample(
+        directories[1:], int(len(directories[1:]) * args.calendar_fraction)))
+
+    for directory in directories:
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+
+    for directory in calendar_directories:
+        with open(os.path.join(root, directory, ".markupserve_dir_config"),
+                  "w") as fp:
+            fp.write("[style]\nname: calendar\nfile_prefix: %s\n"
+                     "file_suffix: .md\n" % (CALENDAR_FILE_PREFIX))
+
+    files = []
+    start_date = datetime.date(2010, 1, 1)
+
+    for i in range(args.files):
+        directory = directories[i % len(directories)]
+
+        if directory in calendar_directories:
+            date = start_date + datetime.timedelta(i)
+            filename = "%s%s.md" % (CALENDAR_FILE_PREFIX, date.isoformat())
+        else:
+            filename = "doc%d.md" % (i)
+
+        path = os.path.join(directory, filename)
+
+        with open(os.path.join(root, path), "w") as fp:
+            fp.write(markdown_document(
+                rng, rng.randint(args.min_size, args.max_size),
+                args.code_fraction))
+
+        files.append(path)
+
+    return (files, [x for x in directories if x not in calendar_directories],
+            sorted(calendar_directories))
+
+
+def write_config(work_root, args):
+    config_path = os.path.join(work_root, "config.cfg")
+
+    if args.converter == "module":
+        converter = "module = ./md-renderer.py:render_contents"
+    else:
+        converter = "binary = ./md-renderer.py\npool_size = %d" % (
+            args.pool_size)
+
+    with open(config_path, "w") as fp:
+        fp.write("[markupserve]\n"
+                 "document_root = %s\n"
+                 "index_root = %s\n"
+                 "port = 8080\n"
+                 "index_procs = %d\n"
+                 "\n"
+                 "[format:markdown]\n"
+                 "suffixes = .md\n"
+                 "%s\n" % (os.path.join(work_root, "docs"),
+                           os.path.join(work_root, "index"),
+                           args.index_procs, converter))
+
+    return config_path
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return latencies[min(int(len(latencies) * p / 100),
+                             len(latencies) - 1)]
+
+    return {
+        "requests": len(latencies),
+        "mean": sum(latencies) / len(latencies),
+        "p50": percentile(50),
+        "p90": percentile(90),
+        "p99": percentile(99),
+        "max": latencies[-1]
+        }
+
+
+def measure_requests(markupserve, urls):
+    latencies = []
+
+    for url in urls:
+        start_time = time.perf_counter()
+        (status, _, _) = markupserve.wsgi_get(url)
+        latencies.append(time.perf_counter() - start_time)
+
+        if status != 200:
+            sys.exit("%s returned status %d" % (url, status))
+
+    return percentiles(latencies)
+
+
+def throughput(files, elapsed):
+    return {
+        "files": files,
+        "seconds": elapsed,
+        "files_per_second": files / max(elapsed, 1e-6)
+        }
+
+
+def modify_tree(docs_root, files, args):
+    """
+    Changes, adds and removes args.update_fraction of the documents each.
+    Returns the number of files changed.
+    """
+    rng = random.Random(args.seed + 1)
+    count = max(int(len(files) * args.update_fraction), 1)
+
+    for path in rng.sample(files, count):
+        with open(os.path.join(docs_root, path), "a") as fp:
+            fp.write("\n%s\n" % (sentence(rng)))
+
+    for i in range(count):
+        path = os.path.join(os.path.dirname(rng.choice(files)),
+                            "new%d.md" % (i))
+
+        with open(os.path.join(docs_root, path), "w") as fp:
+            fp.write(markdown_document(rng, args.min_size,
+                                       args.code_fraction))
+
+    for path in rng.sample(files, count):
+        os.remove(os.path.join(docs_root, path))
+
+    return count * 3
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="benchmarks MarkupServe against a generated tree of "
+        "Markdown documents")
+    parser.add_argument("-o", "--output", default="bench_output.json",
+                        help="file to write results to")
+    parser.add_argument("--files", type=int, default=1000,
+                        help="number of documents")
+    parser.add_argument("--depth", type=int, default=2,
+                        help="depth of the directory tree")
+    parser.add_argument("--fanout", type=int, default=4,
+                        help="subdirectories in each directory")
+    parser.add_argument("--min-size", type=int, default=1000,
+                        help="smallest document size in bytes")
+    parser.add_argument("--max-size", type=int, default=20000,
+                        help="largest document size in bytes")
+    parser.add_argument("--calendar-fraction", type=float, default=0.2,
+                        help="fraction of directories shown as calendars")
+    parser.add_argument("--code-fraction", type=float, default=0.3,
+                        help="chance of each section having a code block")
+    parser.add_argument("--requests", type=int, default=200,
+                        help="requests to make of each kind")
+    parser.add_argument("--update-fraction", type=float, default=0.05,
+                        help="fraction of documents each changed, added and "
+                        "removed before updating the index")
+    parser.add_argument("--converter", choices=("module", "binary"),
+                        default="module",
+                        help="run md-renderer.py in-process or as a pooled "
+                        "converter binary")
+    parser.add_argument("--pool-size", type=int, default=4,
+                        help="converter pool size for --converter binary")
+    parser.add_argument("--index-procs", type=int, default=1,
+                        help="processes to build the index with")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true",
+                        help="don't delete the generated tree and index")
+
+    args = parser.parse_args()
+
+    output_path = os.path.abspath(args.output)
+
+    # Templates and md-renderer.py are found relative to the working
+    # directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    import markupserve
+
+    work_root = tempfile.mkdtemp(prefix="markupserve-bench-")
+    docs_root = os.path.join(work_root, "docs")
+
+    print("Generating %d documents in '%s' ..." % (args.files, docs_root))
+    (files, directories, calendar_directories) = generate_tree(docs_root,
+                                                               args)
+
+    # md-renderer.py's highlight cache would otherwise carry over from
+    # earlier runs (making cold views faster than they are) and fill the
+    # user's own cache. Set before the renderer is loaded, and inherited by
+    # converter processes.
+    os.environ["MARKUPSERVE_HIGHLIGHT_CACHE"] = os.path.join(work_root,
+                                                             "highlight")
+
+    markupserve.config.read(write_config(work_root, args))
+    markupserve.parse_config(markupserve.config)
+
+    results = {
+        "parameters": vars(args),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count()
+            }
+        }
+
+    rng = random.Random(args.seed)
+
+    def search_urls():
+        return ["/search?terms=%s" % (rng.choice(WORDS))
+                for _ in range(args.requests)]
+
+    latency = {}
+
+    print("Measuring search latency without an index ...")
+    latency["search_grep"] = measure_requests(markupserve, search_urls())
+
+    # The index isn't opened (or created) until the server starts
+    print("Building index ...")
+    start_time = time.perf_counter()
+    markupserve.open_index(markupserve.IndexJob())
+    results["build_index"] = throughput(len(files),
+                                        time.perf_counter() - start_time)
+
+    def sample(paths):
+        return [rng.choice(paths) for _ in range(args.requests)] \
+            if len(paths) > 0 else []
+
+    def view_urls(paths):
+        return ["/view/" + path for path in paths]
+
+    file_sample = rng.sample(files, min(args.requests, len(files)))
+
+    print("Measuring request latency ...")
+    latency["view_file_cold"] = measure_requests(markupserve,
+                                                 view_urls(file_sample))
+    latency["view_file_warm"] = measure_requests(markupserve,
+                                                 view_urls(file_sample))
+    latency["view_dir"] = measure_requests(
+        markupserve, view_urls(sample(directories)))
+
+    if len(calendar_directories) > 0:
+        latency["view_calendar"] = measure_requests(
+            markupserve, view_urls(sample(calendar_directories)))
+
+    latency["search"] = measure_requests(markupserve, search_urls())
+
+    results["latency"] = latency
+
+    print("Updating index ...")
+    changed = modify_tree(docs_root, files, args)
+
+    job = markupserve.IndexJob()
+    start_time = time.perf_counter()
+    markupserve.run_index_update(job)
+    results["update_index"] = throughput(changed,
+                                         time.perf_counter() - start_time)
+
+    with open(output_path, "w") as fp:
+        json.dump(results, fp, indent=2, sort_keys=True)
+
+    for (name, stats) in sorted(latency.items()):
+        print("%-16s p50 %7.2fms  p90 %7.2fms  p99 %7.2fms" % (
+            name, stats["p50"] * 1000, stats["p90"] * 1000,
+            stats["p99"] * 1000))
+
+    for name in ("build_index", "update_index"):
+        print("%-16s %.1f files/sec" % (name,
+                                        results[name]["files_per_second"]))
+
+    print("Results written to '%s'" % (output_path))
+
+    if args.keep:
+        print("Tree and index kept in '%s'" % (work_root))
+    else:
+        shutil.rmtree(work_root)
+
+
+if __name__ == "__main__":
+    main()
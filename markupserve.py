@@ -1,13 +1,9 @@
 #!/usr/bin/env python
 
-from bottle import run, debug, route, abort, request, static_file, \
-    post, redirect
+from bottle import run, debug, route, abort, request, response, \
+    static_file, post, redirect, parse_date, http_date
 import shlex
 import collections
-import whoosh
-from whoosh.fields import SchemaClass
-from whoosh import index
-from whoosh.qparser import QueryParser
 import configparser
 import os
 import argparse
@@ -19,12 +15,78 @@ import re
 import itertools
 import datetime
 import hashlib
+import functools
+import threading
+import select
+import struct
+import atexit
+import importlib
+import importlib.util
+import sys
+import concurrent.futures
+import mmap
+import gzip
+import zlib
+import socket
+import signal
+import wsgiref.simple_server
+import bottle
+import json
+import contextlib
+import shutil
+import wsgiref.util
+import multiprocessing
+import codecs
+import html
+import html.parser
 
-# Interpret output from render script as UTF-8
-os.environ['PYTHONIOENCODING'] = 'utf_8'
 
 DIR_CONFIG_FILE_NAME = ".markupserve_dir_config"
+BUILD_MANIFEST_FILE_NAME = ".markupserve_build_manifest"
 FILE_READ_BLOCK_SIZE = 2**20
+DEFAULT_RENDER_CACHE_SIZE = 64 * 2**20
+DEFAULT_CACHE_ROOT_SIZE = 2**30
+DEFAULT_PAGE_CACHE_SIZE = 16 * 2**20
+DEFAULT_DIR_CACHE_SIZE = 1024
+DEFAULT_DIR_CACHE_MAX_AGE = 10
+DEFAULT_CACHE_CONTROL = "no-cache"
+# Pages smaller than this aren't worth compressing
+MIN_COMPRESSED_PAGE_SIZE = 1024
+DEFAULT_STREAM_MIN_SIZE = 2**20
+STREAM_BLOCK_SIZE = 64 * 2**10
+# Set in the WSGI environment of requests made by wsgi_get, which read the
+# whole response anyway, so pages aren't streamed to them
+IN_PROCESS_ENVIRON_KEY = "markupserve.in_process"
+# Set by cached_page_response to the ETag of the page's uncompressed bytes
+PAGE_ETAG_ENVIRON_KEY = "markupserve.page_etag"
+DEFAULT_SERVER = "paste"
+DEFAULT_SERVER_THREADS = 10
+
+# Converters that understand this flag run as long-lived workers; see
+# md-renderer.py for a description of the protocol
+CONVERTER_DAEMON_FLAG = "--daemon"
+CONVERTER_DAEMON_HANDSHAKE = b"markupserve-renderer 1\n"
+CONVERTER_BATCH_FLAG = "--batch"
+DEFAULT_BATCH_PROCS = 4
+DEFAULT_CONVERTER_TIMEOUT = 30
+DEFAULT_CONVERTER_MAX_REQUESTS = 1000
+DEFAULT_WATCH_DEBOUNCE = 2
+INDEX_PROGRESS_INTERVAL = 1000
+DEFAULT_SEARCH_PAGE_SIZE = 20
+DEFAULT_SEARCH_FRAGMENTS = 3
+DEFAULT_SEARCH_FRAGMENT_CHARS = 200
+DEFAULT_SEARCH_CACHE_SIZE = 256
+SEARCH_SORT_KEYS = ("path", "mtime")
+# Matches in a document's title or headings rank above matches in its body
+SEARCH_FIELD_BOOSTS = {"title": 3.0, "headings": 2.0, "content": 1.0}
+DEFAULT_GREP_THREADS = 8
+DEFAULT_GREP_MAX_HITS = 1000
+DEFAULT_GREP_TIMEOUT = 10
+# How many files per grep thread are queued while the tree is walked
+GREP_FILES_IN_FLIGHT = 2
+DEFAULT_WATCH_BATCH_SIZE = 500
+# Upper bounds, in seconds, of the buckets of the histograms in /metrics
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
 
 config = configparser.ConfigParser()
 
@@ -39,587 +101,3819 @@ jinja_env.filters['datetime'] = datetime_format
 
 markup_file_suffixes = set()
 markup_file_converter_binaries = {}
-port = None
+converter_pools = {}
+converter_plugins = {}
+converter_limits = {}
+converter_max_concurrency = {}
+converter_timeouts = {}
+# Converter binaries that turned out not to support batch mode
+batch_unsupported_converters = set()
 markupserve_index = None
+index_root = None
+render_cache = None
+page_cache = None
+dir_cache = None
+dir_configs = {}
+# Created by parse_config, like index_write_lock
+dir_configs_lock = None
+index_watcher = None
+index_job = None
+prebuilt_root = None
+prebuilt_manifest = {}
+slow_request_threshold = 0
+# Whether documents are indexed by the text of their rendered HTML rather than
+# by their markup
+index_rendered_text = False
+# Searchers kept open between searches, and cached search results. Created by
+# parse_config.
+search_cache = None
+# Renders in progress, shared by requests for the same unchanged document.
+# Created by parse_config, like index_write_lock.
+render_flights = None
+
+# Held while writing to the index, so that the watcher and /update_index
+# don't contend for whoosh's writer lock. Created by parse_config, so that
+# it's a gevent lock when serving with gevent.
+index_write_lock = None
+
+# Set once the index has been opened by the worker that creates it, when
+# serving with several worker processes
+index_ready_event = None
+
+
+def markupserve_schema():
+    """
+    Returns the schema of the search index. whoosh is imported by the
+    functions that use it rather than at startup, since it's slow to import.
+    """
+    from whoosh.fields import Schema, ID, TEXT, STORED
+    from whoosh.analysis import StemmingAnalyzer
+
+    return Schema(
+        path=ID(stored=True),
+        title=TEXT(stored=True),
+        # Content isn't stored, to keep the index small; search results are
+        # highlighted from the files themselves
+        content=TEXT(analyzer=StemmingAnalyzer(), stored=False),
+        # Text of the document's headings, when indexing rendered text
+        headings=TEXT(analyzer=StemmingAnalyzer(), stored=False),
+        # 'rendered' if content is the text of the document's rendered HTML,
+        # or 'markup' (or missing, for older indexes) if it's the document
+        # itself
+        content_source=ID(stored=True),
+        file_hash=ID(stored=True),
+        # Stat of the file when it was indexed, used to skip unchanged files
+        mtime=STORED(),
+        size=STORED(),
+        inode=STORED())
+
+
+def converter_environment():
+    # Interpret output from render script as UTF-8
+    return dict(os.environ, PYTHONIOENCODING="utf_8")
+
+
+class Histogram(object):
+    """
+    Counts observed durations in METRICS_BUCKETS, as a Prometheus histogram
+    """
 
+    def __init__(self):
+        self.bucket_counts = [0] * len(METRICS_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
 
-class MarkupServeSchema(SchemaClass):
-    path = whoosh.fields.ID(stored=True)
-    title = whoosh.fields.TEXT(stored=True)
-    content = whoosh.fields.TEXT(
-        analyzer=(whoosh.analysis.StemmingAnalyzer()),
-        stored=True)
-    file_hash = whoosh.fields.ID(stored=True)
-
+    def observe(self, value):
+        for (i, bucket) in enumerate(METRICS_BUCKETS):
+            if value <= bucket:
+                self.bucket_counts[i] += 1
 
-# From http://code.activestate.com/recipes/
-# 466341-guaranteed-conversion-to-unicode-or-byte-string/
-def safe_unicode(obj, *args):
-    """ return the unicode representation of obj """
-    try:
-        return str(obj, *args)
-    except UnicodeDecodeError:
-        # obj is byte string
-        ascii_text = str(obj).encode('string_escape')
-        return str(ascii_text)
+        self.count += 1
+        self.sum += value
 
 
-def find_program(program):
-    for path in os.environ["PATH"].split(os.pathsep):
-        executable = os.path.join(path, program)
-        if os.path.exists(executable) and os.access(executable, os.X_OK):
-            return os.path.abspath(executable)
-    return None
+class Metrics(object):
+    """
+    Histograms of how long requests and the spans within them (see span())
+    take, reported by /metrics. Each server process keeps its own.
+    """
 
+    def __init__(self):
+        self.histograms = collections.OrderedDict()
+        self.lock = threading.Lock()
 
-def last_modified_string(file_path):
-    return time.strftime("%Y/%m/%d %I:%M:%S %p", time.localtime(
-        os.path.getmtime(file_path)))
+    def observe(self, name, labels, value):
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
 
+            if histogram is None:
+                histogram = Histogram()
+                self.histograms[(name, labels)] = histogram
 
-def file_path_to_server_path(path, root):
-    if path is None:
-        return '/view'
+            histogram.observe(value)
 
-    return os.path.join("/view", os.path.relpath(path, root))
+    def exposition(self):
+        """
+        Returns the histograms' lines in Prometheus' text format
+        """
+        lines = []
+        names_seen = set()
 
+        with self.lock:
+            # Samples of the same metric have to be listed together
+            for ((name, labels), histogram) in sorted(
+                    self.histograms.items(), key=lambda item: item[0][0]):
+                if name not in names_seen:
+                    lines.append("# TYPE %s histogram" % (name))
+                    names_seen.add(name)
 
-def view_calendar(path, parent_path, root, config):
-    files = os.listdir(path)
+                for (bucket, count) in zip(METRICS_BUCKETS + ("+Inf",),
+                                           histogram.bucket_counts +
+                                           [histogram.count]):
+                    lines.append(metric_line(name + "_bucket", labels +
+                                             (("le", str(bucket)),), count))
 
-    try:
-        file_prefix = config.get("style", "file_prefix").strip('"').strip("'")
-    except configparser.Error:
-        file_prefix = ""
+                lines.append(metric_line(name + "_sum", labels,
+                                         histogram.sum))
+                lines.append(metric_line(name + "_count", labels,
+                                         histogram.count))
 
-    try:
-        file_suffix = config.get("style", "file_suffix").strip('"').strip("'")
-    except configparser.Error:
-        file_suffix = ""
+        return lines
 
-    filename_regex = re.compile("%s([0-9]+)-([0-9]+)-([0-9]+)%s" %
-                                (file_prefix, file_suffix))
 
-    def regex_match_function(x):
-        match = filename_regex.match(x)
+def metric_line(name, labels, value):
+    """
+    Formats a sample in Prometheus' text format. labels is a tuple of
+    (name, value) pairs.
+    """
+    if len(labels) == 0:
+        return "%s %s" % (name, value)
 
-        if match is not None:
-            return match.groups()
-        else:
-            return None
+    label_strings = []
 
-    file_dates = [match for match in map(regex_match_function, files)]
+    for (label_name, label_value) in labels:
+        label_value = str(label_value).replace("\\", "\\\\").replace(
+            '"', '\\"').replace("\n", "\\n")
+        label_strings.append('%s="%s"' % (label_name, label_value))
 
-    files_by_month = {}
+    return "%s{%s} %s" % (name, ",".join(label_strings), value)
 
-    for filename, date in zip(files, file_dates):
-        if date is None:
-            continue
 
-        file_path = os.path.join(path, filename)
-        year, month, day = list(map(int, date))
-        date = datetime.date(year, month, day)
+# Created by parse_config, after gevent (if it's used) has patched threading,
+# so that spans are recorded per greenlet rather than per thread
+metrics = None
 
-        year_and_month = (year, month)
+# Spans timed while handling the current request, for the slow request log
+request_timings = None
 
-        if year_and_month not in files_by_month:
-            files_by_month[year_and_month] = {}
 
-        files_by_month[year_and_month][date] = file_path
+@contextlib.contextmanager
+def span(name):
+    """
+    Times the enclosed block, recording it in the span histogram in /metrics
+    and against the current request
+    """
+    start_time = time.perf_counter()
 
-    calendars = {}
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start_time
 
-    cal = calendar.Calendar()
-    # Render weeks beginning on Sunday
-    cal.setfirstweekday(6)
+        metrics.observe("markupserve_span_duration_seconds",
+                        (("span", name),), elapsed)
 
-    for year_and_month, dates in list(files_by_month.items()):
-        year, month = year_and_month
+        request_spans = getattr(request_timings, "spans", None)
 
-        if year not in calendars:
-            calendars[year] = {}
+        if request_spans is not None:
+            request_spans.append((name, elapsed))
 
-        calendars[year][month] = []
 
-        for week in cal.monthdatescalendar(year, month):
-            week_list = []
-            for date in week:
-                date_info = {}
+class RenderCache(object):
+    """
+    Caches converter output so that unchanged documents aren't re-rendered.
 
-                if date in files_by_month[year_and_month]:
-                    date_info["link"] = file_path_to_server_path(
-                        files_by_month[year_and_month][date], root)
+    Entries are keyed on the document's path, mtime and size and on the
+    identity of the converter that rendered it. Recently used entries are
+    kept in memory up to max_bytes of output; if cache_root is given,
+    rendered output is also written there so it survives restarts.
 
-                date_info["day_of_month"] = date.day
+    Entries on disk are spread over DISK_DIRECTORIES directories by the hash
+    of their paths. Once a directory's entries take up more than its share of
+    max_disk_bytes, its least recently used entries are removed.
+    """
 
-                if date.month == month:
-                    date_info["style_class"] = "cur_month_date"
-                else:
-                    date_info["style_class"] = "adjacent_month_date"
+    DISK_DIRECTORIES = 256
+
+    def __init__(self, max_bytes, cache_root=None,
+                 max_disk_bytes=DEFAULT_CACHE_ROOT_SIZE):
+        self.max_bytes = max_bytes
+        self.cache_root = cache_root
+        self.max_directory_bytes = max_disk_bytes / self.DISK_DIRECTORIES
+        self.entries = collections.OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        if cache_root is not None and not os.path.isdir(cache_root):
+            os.makedirs(cache_root)
+
+    def disk_path(self, path):
+        # One file per document, so stale renders are overwritten rather
+        # than accumulating
+        path_hash = hashlib.sha1(path.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_root, path_hash[:2], path_hash)
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+
+        output = self.read_from_disk(key)
+
+        with self.lock:
+            if output is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.store(key, output)
 
-                week_list.append(date_info)
+        return output
 
-            calendars[year][month].append(week_list)
+    def put(self, key, output):
+        with self.lock:
+            self.store(key, output)
 
-    template = jinja_env.get_template("calendar.jinja")
+        self.write_to_disk(key, output)
 
-    return template.render(
-        calendars=calendars,
-        month_names=calendar.month_name,
-        path=path,
-        parent_path=file_path_to_server_path(parent_path, root))
+    def invalidate(self, path):
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == path]:
+                self.current_bytes -= len(self.entries.pop(key))
 
+        if self.cache_root is not None:
+            try:
+                os.remove(self.disk_path(path))
+            except OSError:
+                pass
 
-def view_dir(path, parent_path, root, sorted_by, reverse):
-    files = os.listdir(path)
+    def store(self, key, output):
+        # Caller must hold self.lock
+        if len(output) > self.max_bytes:
+            return
 
-    listable_files = []
+        if key in self.entries:
+            self.current_bytes -= len(self.entries.pop(key))
 
-    for filename in files:
-        if filename[0] == '.' or os.path.splitext(filename)[1] == ".resources":
-            continue
+        self.entries[key] = output
+        self.current_bytes += len(output)
 
-        file_info = {}
+        while self.current_bytes > self.max_bytes:
+            (_, evicted) = self.entries.popitem(last=False)
+            self.current_bytes -= len(evicted)
 
-        file_path = os.path.join(path, filename)
+    def read_from_disk(self, key):
+        if self.cache_root is None:
+            return None
 
-        file_info["name"] = filename
+        disk_path = self.disk_path(key[0])
 
-        if os.path.isdir(file_path):
-            file_info["icon"] = "/static/folder.png"
-        else:
-            file_info["icon"] = "/static/file.png"
+        try:
+            with open(disk_path, 'rb') as fp:
+                stored_key = fp.readline()
+                output = fp.read()
+        except OSError:
+            return None
 
-        file_info["link"] = file_path_to_server_path(file_path, root)
+        if stored_key != (repr(key) + '\n').encode("utf-8"):
+            return None
 
-        file_info["last_modified"] = last_modified_string(file_path)
+        try:
+            # Mark the entry as recently used
+            os.utime(disk_path)
+        except OSError:
+            pass
 
-        listable_files.append(file_info)
+        return output
 
-    if sorted_by is not None:
-        listable_files.sort(key=lambda x: x[sorted_by], reverse=reverse)
+    def write_to_disk(self, key, output):
+        if self.cache_root is None:
+            return
 
-    if parent_path is not None:
-        parent_path_info = {
-            "name": "Parent Directory",
-            "link": file_path_to_server_path(parent_path, root),
-            "last_modified": last_modified_string(parent_path),
-            "icon": "/static/up.png"
-            }
+        disk_path = self.disk_path(key[0])
+        temp_path = "%s.%d.%d" % (disk_path, os.getpid(),
+                                  threading.get_ident())
 
-        listable_files.insert(0, parent_path_info)
+        try:
+            os.makedirs(os.path.dirname(disk_path), exist_ok=True)
 
-    template = jinja_env.get_template("dir.jinja")
+            with open(temp_path, 'wb') as fp:
+                fp.write((repr(key) + '\n').encode("utf-8"))
+                fp.write(output)
 
-    page_uri = file_path_to_server_path(path, root)
+            os.replace(temp_path, disk_path)
+        except OSError as e:
+            print("Can't write render cache entry for '%s': %s" % (key[0], e))
+            return
 
-    return template.render(files=listable_files, path=path,
-                           page_uri=page_uri, sorted_by=sorted_by,
-                           reverse=reverse)
+        self.evict_from_disk(os.path.dirname(disk_path))
 
+    def evict_from_disk(self, directory):
+        entries = []
 
-def view_file(path, root):
-    file_suffix = os.path.splitext(path)[1]
+        try:
+            with os.scandir(directory) as directory_entries:
+                for entry in directory_entries:
+                    # Skip other writers' temporary files
+                    if "." in entry.name:
+                        continue
 
-    parent_dir = os.path.abspath(os.path.join(path, os.pardir))
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
 
-    files_in_dir = [x for x in os.listdir(parent_dir) if os.path.splitext(x)[1] != ".resources" and x[0] != '.']
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            return
 
-    files_in_dir.sort()
+        directory_bytes = sum(size for (_, size, _) in entries)
 
-    file_index = files_in_dir.index(os.path.relpath(path, parent_dir))
+        if directory_bytes <= self.max_directory_bytes:
+            return
 
-    def make_path_struct(filename):
-        path_dict = {
-            "name": os.path.splitext(filename)[0],
-            "link": '/'.join(("/view", os.path.relpath(parent_dir, root),
-                              filename))
-            }
+        # Make some room, so that eviction doesn't happen on every write
+        for (_, size, path) in sorted(entries):
+            if directory_bytes <= self.max_directory_bytes * 0.9:
+                break
 
-        return path_dict
+            try:
+                os.remove(path)
+                directory_bytes -= size
+            except OSError:
+                pass
 
-    if file_index > 0:
-        prev_path = make_path_struct(files_in_dir[file_index - 1])
-    else:
-        prev_path = None
 
-    if file_index < len(files_in_dir) - 1:
-        next_path = make_path_struct(files_in_dir[file_index + 1])
-    else:
-        next_path = None
+class DirectoryCache(object):
+    """
+    Caches directory listings (see scan_directory), keyed on each directory's
+    mtime.
 
-    if file_suffix not in markup_file_suffixes:
-        return static_file(path, root="/")
+    Changing a file's contents doesn't change its directory's mtime, so
+    listings are also re-scanned once they're max_age seconds old to keep
+    the modification times they report current. At most max_entries
+    listings are kept.
+    """
 
-    converter_bin = markup_file_converter_binaries[file_suffix]
+    def __init__(self, max_entries, max_age):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.listings = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
 
-    command = shlex.split('%s "%s"' % (converter_bin, path))
+    def get(self, path):
+        dir_mtime = os.stat(path).st_mtime_ns
 
-    render_process = subprocess.Popen(command, stdout=subprocess.PIPE,
-                                      stderr=subprocess.PIPE)
+        with self.lock:
+            listing = self.listings.get(path)
 
-    (output, error) = render_process.communicate()
+            if listing is not None and listing["dir_mtime"] == dir_mtime and \
+               time.time() - listing["scan_time"] <= self.max_age:
+                self.listings.move_to_end(path)
+                self.hits += 1
+                return listing
 
-    if render_process.returncode != 0:
-        abort(500, "Conversion of '%s' failed with error %d: %s %s"
-              % (path, render_process.returncode, output, error))
+            self.misses += 1
 
-    template = jinja_env.get_template("file.jinja")
+        listing = scan_directory(path)
+        listing["dir_mtime"] = dir_mtime
 
-    filename = os.path.splitext(os.path.basename(path))[0]
+        with self.lock:
+            self.listings[path] = listing
+            self.listings.move_to_end(path)
 
-    parent_path = "/view/" + os.path.relpath(parent_dir, root)
+            while len(self.listings) > self.max_entries:
+                self.listings.popitem(last=False)
 
-    # Get rid of any Unicode garbage that Jinja might choke on
-    output = output.decode("utf-8")
+        return listing
 
-    return template.render(
-        filename=filename, last_modified=os.path.getmtime(path), content=output,
-        parent=parent_path, prev=prev_path, next=next_path)
+    def invalidate(self, path):
+        with self.lock:
+            self.listings.pop(path, None)
 
 
-@route("/static/:filename")
-def serve_static_file(filename):
-    static_root = os.path.join(os.path.dirname(__file__), "static")
+class SearchCache(object):
+    """
+    Keeps searchers over the index open between searches, refreshing them
+    when the index changes, and caches up to max_entries pages of search
+    results keyed on the generation of the index they were found in, so that
+    results are never served from an older version of the index.
 
-    return static_file(filename, root=static_root)
+    whoosh searchers can't be shared between threads, so each search borrows
+    an idle searcher (or opens a new one) and returns it when it's done.
+    """
 
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.results = collections.OrderedDict()
+        self.idle_searchers = []
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
 
-def grep_search(search_terms, document_root):
-    command = shlex.split('grep -Hir "%s" %s' % (search_terms, document_root))
+    @contextlib.contextmanager
+    def searcher(self, search_index):
+        with self.lock:
+            (searcher_index, searcher) = self.idle_searchers.pop() \
+                if len(self.idle_searchers) > 0 else (None, None)
 
-    grep_process = subprocess.Popen(command, stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE)
+        if searcher_index is not search_index:
+            # The index has been re-opened since the searcher was
+            if searcher is not None:
+                searcher.close()
 
-    (output, error) = grep_process.communicate()
+            searcher = search_index.searcher()
+        elif not searcher.up_to_date():
+            searcher = searcher.refresh()
 
-    if grep_process.returncode not in [0, 1]:
-        abort(500, "'%s' failed with error %d: %s %s" % (
-            command, grep_process.returncode, output, error))
+        try:
+            yield searcher
+        finally:
+            with self.lock:
+                self.idle_searchers.append((search_index, searcher))
 
-    results = collections.defaultdict(list)
+    def get(self, key):
+        with self.lock:
+            results = self.results.get(key)
 
-    for match in output.split('\n'):
-        if len(match) == 0:
-            continue
+            if results is None:
+                self.misses += 1
+                return None
 
-        (filename, delim, line_text) = match.partition(':')
+            self.results.move_to_end(key)
+            self.hits += 1
 
-        file_extension = os.path.splitext(filename)[1]
+            return results
 
-        if file_extension not in markup_file_suffixes:
-            continue
+    def put(self, key, results):
+        if self.max_entries <= 0:
+            return
 
-        filename = os.path.relpath(filename, document_root)
+        with self.lock:
+            self.results[key] = results
+            self.results.move_to_end(key)
 
-        results[filename].append(str(line_text, "utf8"))
+            while len(self.results) > self.max_entries:
+                self.results.popitem(last=False)
 
-    return results
+    def invalidate(self):
+        """
+        Drops every cached result; called when this process commits to the
+        index, since results from older versions of it won't be used again
+        """
+        with self.lock:
+            self.results.clear()
 
 
-def index_search(search_terms, document_root):
-    qp = QueryParser("content", schema=markupserve_index.schema)
-    query = qp.parse(safe_unicode(search_terms))
+class ConverterError(Exception):
+    pass
 
-    results = collections.defaultdict(list)
 
-    with markupserve_index.searcher() as searcher:
-        query_results = searcher.search(query, limit=None)
+class SingleFlight(object):
+    """
+    Runs at most one call at a time for each key: callers asking for a key
+    that's already being computed wait for and share its result (or
+    exception) rather than computing it again
+    """
 
-        for result in query_results:
-            filename = result["path"].decode("utf-8").decode("unicode-escape")
-            results[filename].append(
-                result.highlights("content").decode("utf-8")
-                .decode("unicode-escape"))
+    def __init__(self):
+        self.calls = {}
+        self.coalesced = 0
+        self.lock = threading.Lock()
 
-    return results
+    def run(self, key, function):
+        with self.lock:
+            call = self.calls.get(key)
 
+            leader = call is None
 
-@route("/search")
-def search():
-    search_terms = request.GET.dict["terms"][0]
+            if leader:
+                call = concurrent.futures.Future()
+                self.calls[key] = call
+            else:
+                self.coalesced += 1
 
-    document_root = os.path.expanduser(config.get(
-        "markupserve", "document_root"))
+        if not leader:
+            return call.result()
 
-    if markupserve_index is None:
-        search_function = grep_search
-    else:
-        search_function = index_search
+        try:
+            result = function()
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+        finally:
+            with self.lock:
+                del self.calls[key]
 
-    results = search_function(search_terms, document_root)
-    template = jinja_env.get_template("search.jinja")
-    return template.render(terms=search_terms, results=results)
+        return result
 
 
-@route("/view/:path#.+#")
-def view(path):
+class ConverterWorker(object):
     """
-    Handles the viewing of a file
+    A converter process started in daemon mode, which renders one document
+    per request for as long as it lives, or in batch mode (if mode_flag is
+    CONVERTER_BATCH_FLAG), which renders a list of documents given all at once
     """
 
-    if "sorted_by" in request.GET.dict:
-        sorted_by = request.GET.dict["sorted_by"][0]
-    else:
-        sorted_by = None
+    def __init__(self, converter_bin, timeout,
+                 mode_flag=CONVERTER_DAEMON_FLAG):
+        self.requests = 0
+        self.exited = False
 
-    reverse = "reverse" in request.GET and (
-        int(request.GET.dict["reverse"][0]) == 1)
+        command = shlex.split(converter_bin) + [mode_flag]
 
-    document_root = os.path.expanduser(config.get("markupserve", "document_root"))
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL,
+                                        env=converter_environment(),
+                                        bufsize=0)
 
-    absolute_path = os.path.abspath(document_root + "/" + path)
+        try:
+            handshake = self.read(len(CONVERTER_DAEMON_HANDSHAKE),
+                                  time.time() + timeout)
+        except ConverterError:
+            handshake = None
 
-    if not os.path.exists(absolute_path):
-        abort(404, "The path '%s' couldn't be found" % (absolute_path))
+        if handshake != CONVERTER_DAEMON_HANDSHAKE:
+            self.kill()
+            raise ConverterError("'%s' doesn't support '%s'" %
+                                 (converter_bin, mode_flag))
 
-    if os.path.isdir(absolute_path):
-        if path != "/":
-            parent_path = os.path.abspath(absolute_path + "/" + os.pardir)
-        else:
-            parent_path = None
+    def read(self, length, deadline):
+        fd = self.process.stdout.fileno()
+        chunks = []
 
-        markupserve_dir_config_file = os.path.join(absolute_path,
-                                                   DIR_CONFIG_FILE_NAME)
+        while length > 0:
+            remaining = deadline - time.time()
 
-        if os.path.exists(markupserve_dir_config_file):
-            dir_config = configparser.ConfigParser()
-            parsed_files = dir_config.read([markupserve_dir_config_file])
+            if remaining <= 0 or len(select.select([fd], [], [],
+                                                   remaining)[0]) == 0:
+                raise ConverterError("Timed out waiting for converter")
 
-            if len(parsed_files) != 1:
-                abort(500, "Can't parse dir config file '%s'" %
-                      (markupserve_dir_config_file))
+            chunk = os.read(fd, length)
 
-            try:
-                dir_style = dir_config.get("style", "name")
-            except configparser.Error:
-                abort(500, "Can't find option ('style', 'name') in directory "
-                      "config")
+            if len(chunk) == 0:
+                self.exited = True
+                raise ConverterError("Converter exited with status %s" %
+                                     (self.process.poll()))
 
-            if dir_style == "calendar":
-                return view_calendar(absolute_path, parent_path, document_root,
-                                     dir_config)
+            chunks.append(chunk)
+            length -= len(chunk)
 
-        return view_dir(absolute_path, parent_path, document_root,
-                        sorted_by, reverse)
-    else:
-        return view_file(absolute_path, document_root)
+        return b''.join(chunks)
 
+    def write(self, data, deadline):
+        fd = self.process.stdin.fileno()
 
-@route("/")
-@route("/view/")
-def view_index():
-    return view("/")
+        while len(data) > 0:
+            remaining = deadline - time.time()
 
+            if remaining <= 0 or len(select.select([], [fd], [],
+                                                   remaining)[1]) == 0:
+                raise ConverterError("Timed out writing to converter")
 
-def hash_file_contents(contents):
-    return hashlib.md5(contents).hexdigest()
+            # A pipe that's writable has room for at least PIPE_BUF bytes, so
+            # writing no more than that doesn't block
+            try:
+                written = os.write(fd, data[:select.PIPE_BUF])
+            except OSError as e:
+                self.exited = True
+                raise ConverterError("Can't write to converter: %s" % (e))
 
+            data = data[written:]
 
-def add_file_to_index(filename, document_root, writer):
-    file_basename = os.path.basename(filename)
+    def render(self, path, timeout):
+        self.requests += 1
 
-    filename_root = os.path.splitext(file_basename)[0]
+        encoded_path = path.encode("utf-8")
 
-    with open(filename, 'r') as fp:
-        file_contents = fp.read()
+        try:
+            self.process.stdin.write(struct.pack(">I", len(encoded_path)))
+            self.process.stdin.write(encoded_path)
+        except OSError as e:
+            self.exited = True
+            raise ConverterError("Can't write to converter: %s" % (e))
 
-    file_hash = hash_file_contents(file_contents)
+        deadline = time.time() + timeout
+        (status, length) = struct.unpack(">BI", self.read(5, deadline))
+        output = self.read(length, deadline)
 
-    writer.add_document(
-        title=safe_unicode(filename_root),
-        content=safe_unicode(file_contents),
-        file_hash=safe_unicode(file_hash),
-        path=safe_unicode(
-            os.path.relpath(filename, document_root)))
+        return (status, output)
 
+    def render_batch(self, paths, timeout):
+        """
+        Sends a batch mode converter the paths to render, one per line, and
+        yields a (status, output) pair for each in turn as it's rendered
+        """
+        manifest = "".join(path + "\n" for path in paths).encode("utf-8")
 
-def remove_file_from_index(filename, document_root, writer):
-    writer.delete_by_term(
-        'path', safe_unicode(os.path.relpath(filename, document_root)))
+        self.write(manifest, time.time() + timeout)
+        self.process.stdin.close()
 
+        for path in paths:
+            self.requests += 1
 
-def markup_files_in_subtree(root):
-    for dirpath, dirnames, filenames in os.walk(root):
-        for filename in filenames:
-            extension = os.path.splitext(filename)[1]
+            deadline = time.time() + timeout
+            (status, length) = struct.unpack(">BI", self.read(5, deadline))
 
-            if extension not in markup_file_suffixes:
-                continue
-            else:
-                yield os.path.join(dirpath, filename)
+            yield (status, self.read(length, deadline))
 
+    def kill(self):
+        if self.process.poll() is None:
+            self.process.kill()
 
-def build_index(writer):
-    document_root = os.path.expanduser(config.get(
-        "markupserve", "document_root"))
+        self.process.wait()
+        self.process.stdin.close()
+        self.process.stdout.close()
 
-    for file_abspath in markup_files_in_subtree(document_root):
-        add_file_to_index(file_abspath, document_root, writer)
 
+class ConverterPool(object):
+    """
+    A bounded pool of daemon-mode workers for a single converter.
 
-@post("/update_index")
-def update_index():
-    document_root = os.path.expanduser(config.get(
-        "markupserve", "document_root"))
+    Workers are started on demand, killed if they time out or crash, and
+    replaced once they have served max_requests documents. If the converter
+    doesn't support daemon mode, supported is set to False and callers
+    should fall back to running the converter once per document.
+    """
 
-    indexed_paths = set()
-    to_index = set()
+    def __init__(self, converter_bin, size, timeout, max_requests):
+        self.converter_bin = converter_bin
+        self.timeout = timeout
+        self.max_requests = max_requests
+        self.supported = True
+        self.size = size
+        self.idle_workers = []
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        # Counted for /metrics
+        self.busy_workers = 0
+        self.workers_started = 0
+        self.renders = 0
+        self.failures = 0
+
+    def get_worker(self):
+        with self.lock:
+            if len(self.idle_workers) > 0:
+                return self.idle_workers.pop()
+
+        try:
+            worker = ConverterWorker(self.converter_bin, self.timeout)
+        except ConverterError:
+            self.supported = False
+            raise
+
+        with self.lock:
+            self.workers_started += 1
+
+        return worker
+
+    def render(self, path):
+        """
+        Returns (status, output) for the document at path. Raises
+        ConverterError if no worker could render it.
+        """
+        with self.slots:
+            with self.lock:
+                self.busy_workers += 1
 
-    print("Starting!")
+            try:
+                (status, output) = self.render_on_worker(path)
+            except ConverterError:
+                with self.lock:
+                    self.failures += 1
 
-    if markupserve_index is None:
-        print("No index found; aborting update")
-        redirect('/')
+                raise
+            finally:
+                with self.lock:
+                    self.busy_workers -= 1
 
-    with markupserve_index.searcher() as searcher:
-        writer = markupserve_index.writer()
+            with self.lock:
+                self.renders += 1
 
-        # Loop over all fields in the index
-        for fields in searcher.all_stored_fields():
-            indexed_path = os.path.join(document_root, fields["path"])
-            indexed_paths.add(indexed_path)
+            return (status, output)
 
-            if not os.path.exists(indexed_path):
-                # File was deleted since we last updated the index
-                print("Deleting '%s' from index" % (indexed_path))
-                remove_file_from_index(indexed_path, document_root, writer)
-            else:
-                # Check if file has been changed by hashing its contents
-                with open(indexed_path, 'r') as fp:
-                    file_hash = hash_file_contents(fp.read())
-
-                if file_hash != fields["file_hash"]:
-                    # File hash mismatch; delete from index and add to the list
-                    # of files to re-index
-                    print("MD5 hash mismatch for '%s': %s != %s" % (
-                        indexed_path, file_hash, fields["file_hash"]))
-                    remove_file_from_index(indexed_path, document_root, writer)
-                    to_index.add(indexed_path)
-
-        # Add any path that has changed (or is not in the index) to the index
-        for file_abspath in markup_files_in_subtree(document_root):
-            if file_abspath in to_index:
-                print("Updating index for '%s'" % (file_abspath))
-                add_file_to_index(file_abspath, document_root, writer)
-            elif file_abspath not in indexed_paths:
-                print("Adding new file '%s' to index" % (file_abspath))
-                add_file_to_index(file_abspath, document_root, writer)
-
-        writer.commit()
-
-        print("Done!")
+    def render_on_worker(self, path):
+        # A worker that has crashed since it last rendered something gets one
+        # replacement before the render is considered failed
+        for attempt in range(2):
+            worker = self.get_worker()
 
-        redirect('/')
+            try:
+                (status, output) = worker.render(path, self.timeout)
+            except ConverterError:
+                worker.kill()
 
+                if attempt == 1 or not worker.exited:
+                    raise
 
-def add_converter(converter_binary, comma_delimited_suffix_list):
-    suffixes = comma_delimited_suffix_list.split(',')
-    suffixes = [x.strip() for x in suffixes]
-    # Don't add a converter for a format that's already been covered
-    suffixes = [x for x in suffixes if x not in markup_file_suffixes]
+                continue
 
-    if len(suffixes) == 0:
-        return
+            if worker.requests >= self.max_requests:
+                worker.kill()
+            else:
+                with self.lock:
+                    self.idle_workers.append(worker)
 
-    # Rewrite the location of the converter binary if its exact location isn't given
-    # but it's in our PATH
-    if not os.path.exists(converter_binary):
-        resolved_binary = find_program(converter_binary)
+            return (status, output)
 
-        if resolved_binary is not None:
-            converter_binary = resolved_binary
-        else:
-            exit("Can't find converter binary '%s'" % (converter_binary))
+    def shutdown(self):
+        with self.lock:
+            for worker in self.idle_workers:
+                worker.kill()
 
-    print("Adding converter '%s' for formats %s" % (converter_binary, suffixes))
+            self.idle_workers = []
 
-    for suffix in suffixes:
-        markup_file_suffixes.add(suffix)
-        markup_file_converter_binaries[suffix] = converter_binary
 
+class ConverterPlugin(object):
+    """
+    A Python callable that renders the contents of a markup file (as bytes)
+    to HTML inside the server process.
 
-def parse_config(config):
-    global port
+    spec is given as 'module:callable', where module is either an importable
+    module name or the path to a Python file. Renders are run on a thread or
+    process pool of pool_size workers.
+    """
 
-    required_config_present = (
-        config.has_section("markupserve") and
-        config.has_option("markupserve", "document_root") and
-        config.has_option("markupserve", "port"))
+    def __init__(self, spec, pool_type, pool_size, timeout):
+        (module_name, _, function_name) = spec.rpartition(':')
+
+        if len(module_name) == 0:
+            raise ConverterError("Module spec '%s' must have the form "
+                                 "'module:callable'" % (spec))
+
+        module = load_plugin_module(module_name)
+
+        try:
+            self.function = getattr(module, function_name)
+        except AttributeError:
+            raise ConverterError("Module '%s' has no callable named '%s'" %
+                                 (module_name, function_name))
+
+        if pool_type not in ("process", "thread"):
+            raise ConverterError("Unknown pool type '%s'" % (pool_type))
+
+        self.spec = spec
+        self.source_path = os.path.abspath(module.__file__)
+        self.timeout = timeout
+        self.pool_type = pool_type
+        self.pool_size = pool_size
+        self.executor = None
+        self.lock = threading.Lock()
+        # Counted for /metrics
+        self.renders = 0
+        self.failures = 0
+
+    def get_executor(self):
+        # The pool is started on first use rather than when the plugin is
+        # loaded, so that each server worker process gets its own
+        with self.lock:
+            if self.executor is None:
+                if self.pool_type == "process":
+                    self.executor = concurrent.futures.ProcessPoolExecutor(
+                        self.pool_size)
+                else:
+                    self.executor = concurrent.futures.ThreadPoolExecutor(
+                        self.pool_size)
 
-    if not required_config_present:
-        exit("MarkupServe's configuration requires a [markupserve] section "
-             "with options 'document_root' and 'port' defined")
+            return self.executor
 
-    # Legacy support: install markup suffixes and converter
-    if config.has_option("markupserve", "markup_suffixes") and \
-       config.has_option("markupserve", "converter_binary"):
+    def render(self, path):
+        with open(path, 'rb') as fp:
+            file_contents = fp.read()
 
-        add_converter(config.get("markupserve", "converter_binary"),
-                      config.get("markupserve", "markup_suffixes"))
+        future = self.get_executor().submit(self.function, file_contents)
 
-    # Add a converter for each config section available
-    for section in config.sections():
-        if section.startswith("format:"):
-            formatter_config_present = (
-                config.has_option(section, "suffixes") and
-                config.has_option(section, "binary"))
+        try:
+            output = future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            self.count_failure()
+            raise ConverterError("Timed out after %s seconds" %
+                                 (self.timeout))
+        except Exception as e:
+            self.count_failure()
+            raise ConverterError("%s: %s" % (type(e).__name__, e))
 
-            if not formatter_config_present:
-                exit("Section '%s' must define both 'binary' and 'suffixes' options" % (section))
+        with self.lock:
+            self.renders += 1
 
-            add_converter(config.get(section, 'binary'), config.get(section, 'suffixes'))
+        if isinstance(output, str):
+            output = output.encode("utf-8")
 
-    if len(markup_file_suffixes) == 0:
-        exit("Must supply at least one file suffix to parse in config")
+        return output
 
-    port = config.getint("markupserve", "port")
+    def count_failure(self):
+        with self.lock:
+            self.failures += 1
 
-    # Load an index file from index path if one has been specified
-    if config.has_option("markupserve", "index_root"):
-        index_root = os.path.expanduser(config.get("markupserve", "index_root"))
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
 
-        if os.path.isdir(index_root):
-            print("Loading index at '%s'" % (index_root))
-            # Index exists; load it
-            markupserve_index = index.open_dir(index_root)
+
+def load_plugin_module(module_name):
+    if not module_name.endswith(".py"):
+        try:
+            return importlib.import_module(module_name)
+        except ImportError as e:
+            raise ConverterError("Can't import module '%s': %s" %
+                                 (module_name, e))
+
+    module_path = os.path.abspath(os.path.expanduser(module_name))
+
+    # Files like md-renderer.py aren't valid module names, so they're loaded
+    # under a sanitized one. Registering the module in sys.modules lets its
+    # callables be pickled for process pools.
+    sanitized_name = "markupserve_plugin_" + re.sub(
+        r'\W', '_', os.path.splitext(os.path.basename(module_path))[0])
+
+    if sanitized_name in sys.modules:
+        return sys.modules[sanitized_name]
+
+    spec = importlib.util.spec_from_file_location(sanitized_name, module_path)
+
+    if spec is None:
+        raise ConverterError("Can't load module from '%s'" % (module_path))
+
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[sanitized_name] = module
+
+    try:
+        spec.loader.exec_module(module)
+    except Exception as e:
+        del sys.modules[sanitized_name]
+        raise ConverterError("Can't load module from '%s': %s" %
+                             (module_path, e))
+
+    return module
+
+
+class IndexWatcher(threading.Thread):
+    """
+    Keeps the index up to date by periodically scanning document_root for
+    markup files whose stat has changed.
+
+    Changes are queued until none have been seen for debounce seconds (or
+    until batch_size of them are queued) and are then committed to the
+    index together.
+    """
+
+    def __init__(self, document_root, interval, debounce, batch_size):
+        threading.Thread.__init__(self, name="markupserve-index-watcher",
+                                  daemon=True)
+        self.document_root = document_root
+        self.interval = interval
+        self.debounce = debounce
+        self.batch_size = batch_size
+        self.snapshot = None
+        self.pending = set()
+        self.last_change_time = None
+        self.commits = 0
+        self.last_commit_latency = None
+        self.last_error = None
+        self.lock = threading.Lock()
+
+    def scan(self):
+        snapshot = {}
+
+        for file_abspath in markup_files_in_subtree(self.document_root):
+            try:
+                snapshot[file_abspath] = file_stat_fields(
+                    os.stat(file_abspath))
+            except OSError:
+                # Removed since it was listed, or can't be read (e.g. a
+                # symlink loop); either way it can't be indexed
+                continue
+
+        return snapshot
+
+    def find_changes(self):
+        snapshot = self.scan()
+
+        if self.snapshot is not None:
+            changed_paths = set(
+                path for (path, stat) in snapshot.items()
+                if self.snapshot.get(path) != stat)
+            changed_paths.update(set(self.snapshot) - set(snapshot))
+
+            if len(changed_paths) > 0:
+                with self.lock:
+                    self.pending.update(changed_paths)
+                    self.last_change_time = time.time()
+
+        self.snapshot = snapshot
+
+    def commit_pending(self):
+        from whoosh import index
+
+        with self.lock:
+            paths = self.pending
+            self.pending = set()
+
+        start_time = time.time()
+
+        try:
+            with index_write_lock:
+                writer = markupserve_index.writer()
+
+                try:
+                    for path in paths:
+                        error = reindex_file(path, self.document_root, writer)
+
+                        # Files that can't be read are left out of the index
+                        # rather than holding up every other change
+                        if error is not None and \
+                           not isinstance(error, FileNotFoundError):
+                            print("Can't index '%s': %r" % (path, error))
+                            self.last_error = repr(error)
+
+                    with span("index_commit"):
+                        writer.commit()
+                except BaseException:
+                    # Release whoosh's write lock
+                    writer.cancel()
+                    raise
+
+            search_cache.invalidate()
+        except (index.LockError, OSError) as e:
+            # Try again on the next pass
+            self.last_error = repr(e)
+
+            with self.lock:
+                self.pending.update(paths)
+
+            return
+
+        for path in paths:
+            invalidate_caches(path)
+
+        with self.lock:
+            self.commits += 1
+            self.last_commit_latency = time.time() - start_time
+
+    def run(self):
+        while True:
+            try:
+                self.find_changes()
+
+                with self.lock:
+                    ready = len(self.pending) > 0 and (
+                        len(self.pending) >= self.batch_size or
+                        time.time() - self.last_change_time >= self.debounce)
+
+                if ready:
+                    self.commit_pending()
+            except Exception as e:
+                # Keep watching; the next pass may succeed
+                print("Index watcher failed: %r" % (e))
+                self.last_error = repr(e)
+
+            time.sleep(self.interval)
+
+    def status(self):
+        with self.lock:
+            return {
+                "queue_depth": len(self.pending),
+                "commits": self.commits,
+                "last_commit_latency": self.last_commit_latency,
+                "last_error": self.last_error
+                }
+
+
+class IndexJob(object):
+    """
+    Runs index updates and rebuilds on a background thread.
+
+    Only one job runs at a time; starting a job while another is running does
+    nothing, so concurrent requests coalesce into the running job.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.kind = None
+        self.phase = "idle"
+        self.progress = collections.Counter()
+        self.start_time = None
+        self.end_time = None
+        self.last_error = None
+
+    def start(self, kind, function):
+        """
+        Runs function(self) in the background unless a job is already
+        running. Returns True if a new job was started.
+        """
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return False
+
+            self.kind = kind
+            self.phase = "starting"
+            self.progress = collections.Counter()
+            self.start_time = time.time()
+            self.end_time = None
+
+            self.thread = threading.Thread(
+                target=self.run, args=(function,),
+                name="markupserve-index-%s" % (kind), daemon=True)
+            self.thread.start()
+
+            return True
+
+    def run(self, function):
+        try:
+            function(self)
+            self.last_error = None
+        except Exception as e:
+            print("Index %s failed: %s" % (self.kind, e))
+            self.last_error = "%s: %s" % (type(e).__name__, e)
+        finally:
+            self.end_time = time.time()
+            self.set_phase("idle")
+
+    def set_phase(self, phase):
+        self.phase = phase
+
+    def status(self):
+        with self.lock:
+            if self.start_time is None:
+                elapsed = None
+            else:
+                elapsed = (self.end_time or time.time()) - self.start_time
+
+            return {
+                "kind": self.kind,
+                "phase": self.phase,
+                "scanned": self.progress["scanned"],
+                "added": self.progress["added"],
+                "updated": self.progress["updated"],
+                "removed": self.progress["removed"],
+                "elapsed": elapsed,
+                "last_error": self.last_error
+                }
+
+
+# From http://code.activestate.com/recipes/
+# 466341-guaranteed-conversion-to-unicode-or-byte-string/
+def safe_unicode(obj, *args):
+    """ return the unicode representation of obj """
+    try:
+        return str(obj, *args)
+    except UnicodeDecodeError:
+        # obj is byte string
+        ascii_text = str(obj).encode('string_escape')
+        return str(ascii_text)
+
+
+def find_program(program):
+    for path in os.environ["PATH"].split(os.pathsep):
+        executable = os.path.join(path, program)
+        if os.path.exists(executable) and os.access(executable, os.X_OK):
+            return os.path.abspath(executable)
+    return None
+
+
+def last_modified_string(mtime):
+    return time.strftime("%Y/%m/%d %I:%M:%S %p", time.localtime(mtime))
+
+
+def scan_directory(path):
+    """
+    Lists the visible entries in a directory, sorted by name. Returns a dict
+    whose 'entries' are dicts giving each entry's name, whether it's a
+    directory and its mtime, whose 'positions' map each name to its index in
+    'entries', and whose 'has_dir_config' says whether the directory has a
+    directory config file.
+    """
+    entries = []
+    has_dir_config = False
+    scan_time = time.time()
+
+    with span("fs_listing"), os.scandir(path) as directory:
+        for entry in directory:
+            if entry.name == DIR_CONFIG_FILE_NAME:
+                has_dir_config = True
+
+            if entry.name[0] == '.' or \
+               os.path.splitext(entry.name)[1] == ".resources":
+                continue
+
+            try:
+                entries.append({
+                    "name": entry.name,
+                    "is_dir": entry.is_dir(),
+                    "mtime": entry.stat().st_mtime
+                    })
+            except OSError:
+                # Broken symlink, or removed since the directory was read
+                continue
+
+    entries.sort(key=lambda x: x["name"])
+
+    return {
+        "entries": entries,
+        "positions": dict((entry["name"], i) for (i, entry) in
+                          enumerate(entries)),
+        "has_dir_config": has_dir_config,
+        "scan_time": scan_time
+        }
+
+
+def parse_dir_config(config_file):
+    """
+    Parses a directory config file, returning a dict of the settings used to
+    display the directory
+    """
+    dir_config = configparser.ConfigParser()
+    parsed_files = dir_config.read([config_file])
+
+    if len(parsed_files) != 1:
+        abort(500, "Can't parse dir config file '%s'" % (config_file))
+
+    try:
+        dir_style = dir_config.get("style", "name")
+    except configparser.Error:
+        abort(500, "Can't find option ('style', 'name') in directory "
+              "config")
+
+    try:
+        file_prefix = dir_config.get("style", "file_prefix").strip('"').strip(
+            "'")
+    except configparser.Error:
+        file_prefix = ""
+
+    try:
+        file_suffix = dir_config.get("style", "file_suffix").strip('"').strip(
+            "'")
+    except configparser.Error:
+        file_suffix = ""
+
+    return {
+        "style": dir_style,
+        "file_prefix": file_prefix,
+        "file_suffix": file_suffix,
+        "filename_regex": re.compile("%s([0-9]+)-([0-9]+)-([0-9]+)%s" %
+                                     (file_prefix, file_suffix))
+        }
+
+
+def load_dir_config(path, listing):
+    """
+    Returns the parsed directory config (see parse_dir_config) for the
+    directory at path, or None if it doesn't have one. Parsed configs are
+    cached until their file's mtime changes.
+    """
+    if not listing["has_dir_config"]:
+        return None
+
+    config_file = os.path.join(path, DIR_CONFIG_FILE_NAME)
+
+    try:
+        config_mtime = os.stat(config_file).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    with dir_configs_lock:
+        dir_config = dir_configs.get(config_file)
+
+    if dir_config is None or dir_config["mtime"] != config_mtime:
+        dir_config = parse_dir_config(config_file)
+        dir_config["mtime"] = config_mtime
+
+        with dir_configs_lock:
+            dir_configs[config_file] = dir_config
+
+    return dir_config
+
+
+def list_directory(path):
+    if dir_cache is None:
+        return scan_directory(path)
+
+    return dir_cache.get(path)
+
+
+def file_path_to_server_path(path, root):
+    if path is None:
+        return '/view'
+
+    return os.path.join("/view", os.path.relpath(path, root))
+
+
+def page_etag(template_name, *parts):
+    """
+    Returns a strong ETag for a page rendered with the given template from
+    inputs identified by parts
+    """
+    template_mtime = os.stat(
+        jinja_env.get_template(template_name).filename).st_mtime_ns
+
+    return hashlib.sha1(repr((template_name, template_mtime) + parts)
+                        .encode("utf-8")).hexdigest()
+
+
+def page_encoding():
+    """
+    Returns the compression to use for the response ('gzip' or 'deflate'),
+    or None if it shouldn't be compressed
+    """
+    if not config.getboolean("markupserve", "compress_pages", fallback=True):
+        return None
+
+    accepted = set()
+
+    for coding in request.headers.get("Accept-Encoding", "").split(","):
+        (name, _, params) = coding.partition(";")
+
+        if params.replace(" ", "") not in ("q=0", "q=0.0"):
+            accepted.add(name.strip().lower())
+
+    for encoding in ("gzip", "deflate"):
+        if encoding in accepted:
+            return encoding
+
+    return None
+
+
+def client_has_page(etag, last_modified):
+    if_none_match = request.headers.get("If-None-Match")
+
+    if if_none_match is not None:
+        client_etags = [tag.strip() for tag in if_none_match.split(",")]
+
+        return "*" in client_etags or etag in client_etags or \
+            ("W/" + etag) in client_etags
+
+    if_modified_since = parse_date(
+        request.headers.get("If-Modified-Since", ""))
+
+    return if_modified_since is not None and \
+        int(last_modified) <= if_modified_since
+
+
+def prebuilt_page_path(out_root, relative_path, is_dir):
+    """
+    Returns the file that the build command writes the page for a document or
+    directory (given relative to document_root) to, laid out so that a static
+    web server serving out_root answers the same URLs that MarkupServe does
+    """
+    page_path = os.path.normpath(os.path.join(out_root, "view", relative_path))
+
+    if is_dir:
+        page_path = os.path.join(page_path, "index.html")
+
+    return page_path
+
+
+def read_prebuilt_page(path, root, etag):
+    """
+    Returns the page for path written by the build command, or None if there
+    isn't one or it was built from different inputs than the page with the
+    given ETag
+    """
+    if prebuilt_root is None:
+        return None
+
+    relative_path = os.path.relpath(path, root)
+    built_page = prebuilt_manifest.get(relative_path)
+
+    if built_page is None or built_page["etag"] != etag:
+        return None
+
+    try:
+        with open(prebuilt_page_path(prebuilt_root, relative_path,
+                                     built_page["is_dir"]), "rb") as fp:
+            return fp.read().decode("utf-8")
+    except OSError:
+        return None
+
+
+def load_build_manifest(out_root):
+    """
+    Returns the manifest of pages written to out_root by the build command,
+    mapping each page's path relative to document_root to its ETag and
+    whether it's a directory
+    """
+    try:
+        with open(os.path.join(out_root, BUILD_MANIFEST_FILE_NAME)) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+
+def cached_page_response(etag, last_modified, route_name, path, root):
+    """
+    Sets the caching headers for the page for path and returns a response for
+    it if one can be sent without rendering it: an empty body if the client's
+    copy is current (the status is set to 304), the page's compressed bytes if
+    they're cached, or the page written by the build command if it's current.
+    Otherwise returns None, and the page should be rendered and passed to
+    page_response.
+    """
+    base_etag = etag
+    encoding = page_encoding()
+
+    if encoding is not None:
+        # Each encoding is a different representation, so needs its own ETag.
+        # Pages too small to compress are sent as they are, and page_response
+        # puts base_etag back for them
+        etag = "%s-%s" % (etag, encoding)
+
+    request.environ[PAGE_ETAG_ENVIRON_KEY] = base_etag
+
+    response.set_header("ETag", '"%s"' % (etag))
+    response.set_header("Last-Modified", http_date(last_modified))
+    response.set_header("Cache-Control", config.get(
+        "markupserve", "%s_cache_control" % (route_name),
+        fallback=DEFAULT_CACHE_CONTROL))
+    response.set_header("Vary", "Accept-Encoding")
+
+    if client_has_page('"%s"' % (etag), last_modified):
+        response.status = 304
+        return b''
+
+    # A client holding base_etag has the uncompressed page, which is what
+    # it's sent if the page is too small to compress
+    if encoding is not None and "If-None-Match" in request.headers and \
+       client_has_page('"%s"' % (base_etag), last_modified):
+        response.set_header("ETag", '"%s"' % (base_etag))
+        response.status = 304
+        return b''
+
+    if encoding is not None and page_cache is not None:
+        page = page_cache.get((etag,))
+
+        if page is not None:
+            response.set_header("Content-Encoding", encoding)
+            return page
+
+    page = read_prebuilt_page(path, root, base_etag)
+
+    if page is not None:
+        return page_response(page)
+
+    return None
+
+
+def page_response(page):
+    """
+    Returns a rendered page, compressed if the client accepts it. Must be
+    called after cached_page_response.
+    """
+    encoding = page_encoding()
+    page = page.encode("utf-8")
+
+    if encoding is None:
+        return page
+
+    if len(page) < MIN_COMPRESSED_PAGE_SIZE:
+        response.set_header("ETag", '"%s"' % (
+            request.environ[PAGE_ETAG_ENVIRON_KEY]))
+        return page
+
+    if encoding == "gzip":
+        page = gzip.compress(page)
+    else:
+        page = zlib.compress(page)
+
+    response.set_header("Content-Encoding", encoding)
+
+    if page_cache is not None:
+        page_cache.put((response.get_header("ETag").strip('"'),), page)
+
+    return page
+
+
+def render_template(template_name, **context):
+    with span("template"):
+        return jinja_env.get_template(template_name).render(**context)
+
+
+@functools.lru_cache(maxsize=1024)
+def month_grid(year, month):
+    """
+    Returns the weeks of a month, beginning on Sunday, as tuples of dates.
+    Grids are shared by every calendar directory.
+    """
+    cal = calendar.Calendar()
+    # Render weeks beginning on Sunday
+    cal.setfirstweekday(6)
+
+    return tuple(tuple(week) for week in cal.monthdatescalendar(year, month))
+
+
+def calendar_date_index(path, listing, filename_regex):
+    """
+    Returns a dict mapping (year, month) to a dict mapping each date in that
+    month that has a file in the directory at path to the file's path.
+
+    The index is kept with the directory's listing, so it's only rebuilt
+    when the listing is (i.e. when the directory changes).
+    """
+    date_indexes = listing.setdefault("calendar_date_indexes", {})
+
+    if filename_regex.pattern in date_indexes:
+        return date_indexes[filename_regex.pattern]
+
+    files_by_month = {}
+
+    for entry in listing["entries"]:
+        match = filename_regex.match(entry["name"])
+
+        if match is None:
+            continue
+
+        year, month, day = list(map(int, match.groups()))
+
+        try:
+            date = datetime.date(year, month, day)
+        except ValueError:
+            # Not a real date
+            continue
+
+        year_and_month = (year, month)
+
+        if year_and_month not in files_by_month:
+            files_by_month[year_and_month] = {}
+
+        files_by_month[year_and_month][date] = os.path.join(path,
+                                                            entry["name"])
+
+    date_indexes[filename_regex.pattern] = files_by_month
+
+    return files_by_month
+
+
+def view_calendar(path, parent_path, root, dir_config, year=None, month=None,
+                  all_years=False):
+    """
+    Renders a calendar of the dated files in a directory. Only one year (the
+    most recent, unless year is given) is shown unless all_years is True,
+    and if month is given only that month of the year is shown.
+    """
+    listing = list_directory(path)
+
+    etag = page_etag("calendar.jinja", path, root, parent_path,
+                     dir_config["mtime"], listing["entries"], year, month,
+                     all_years)
+    cached_page = cached_page_response(
+        etag, max([dir_config["mtime"] / 1e9] +
+                  [x["mtime"] for x in listing["entries"]]), "calendar",
+        path, root)
+
+    if cached_page is not None:
+        return cached_page
+
+    files_by_month = calendar_date_index(path, listing,
+                                         dir_config["filename_regex"])
+
+    years = sorted(set(x[0] for x in files_by_month), reverse=True)
+
+    if year is None and len(years) > 0:
+        year = years[0]
+
+    calendars = {}
+
+    for year_and_month, dates in list(files_by_month.items()):
+        (cur_year, cur_month) = year_and_month
+
+        if not all_years and (cur_year != year or
+                              (month is not None and cur_month != month)):
+            continue
+
+        if cur_year not in calendars:
+            calendars[cur_year] = {}
+
+        calendars[cur_year][cur_month] = []
+
+        for week in month_grid(cur_year, cur_month):
+            week_list = []
+            for date in week:
+                date_info = {}
+
+                if date in dates:
+                    date_info["link"] = file_path_to_server_path(
+                        dates[date], root)
+
+                date_info["day_of_month"] = date.day
+
+                if date.month == cur_month:
+                    date_info["style_class"] = "cur_month_date"
+                else:
+                    date_info["style_class"] = "adjacent_month_date"
+
+                week_list.append(date_info)
+
+            calendars[cur_year][cur_month].append(week_list)
+
+    return page_response(render_template(
+        "calendar.jinja",
+        calendars=calendars,
+        years=years,
+        month_names=calendar.month_name,
+        path=path,
+        page_uri=file_path_to_server_path(path, root),
+        parent_path=file_path_to_server_path(parent_path, root)))
+
+
+def view_dir(path, parent_path, root, sorted_by, reverse):
+    listing = list_directory(path)
+
+    if parent_path is not None:
+        parent_mtime = os.path.getmtime(parent_path)
+    else:
+        parent_mtime = 0
+
+    etag = page_etag("dir.jinja", path, root, parent_path, parent_mtime,
+                     sorted_by, reverse, listing["entries"])
+    cached_page = cached_page_response(
+        etag, max([os.path.getmtime(path), parent_mtime] +
+                  [x["mtime"] for x in listing["entries"]]), "dir",
+        path, root)
+
+    if cached_page is not None:
+        return cached_page
+
+    listable_files = []
+
+    for entry in listing["entries"]:
+        file_info = {}
+
+        file_path = os.path.join(path, entry["name"])
+
+        file_info["name"] = entry["name"]
+
+        if entry["is_dir"]:
+            file_info["icon"] = "/static/folder.png"
+        else:
+            file_info["icon"] = "/static/file.png"
+
+        file_info["link"] = file_path_to_server_path(file_path, root)
+
+        file_info["last_modified"] = last_modified_string(entry["mtime"])
+
+        listable_files.append(file_info)
+
+    if sorted_by is not None:
+        listable_files.sort(key=lambda x: x[sorted_by], reverse=reverse)
+
+    if parent_path is not None:
+        parent_path_info = {
+            "name": "Parent Directory",
+            "link": file_path_to_server_path(parent_path, root),
+            "last_modified": last_modified_string(parent_mtime),
+            "icon": "/static/up.png"
+            }
+
+        listable_files.insert(0, parent_path_info)
+
+    page_uri = file_path_to_server_path(path, root)
+
+    return page_response(render_template("dir.jinja", files=listable_files,
+                                         path=path, page_uri=page_uri,
+                                         sorted_by=sorted_by,
+                                         reverse=reverse))
+
+
+def run_converter(path, converter_bin):
+    command = shlex.split('%s "%s"' % (converter_bin, path))
+    timeout = converter_timeouts.get(os.path.splitext(path)[1],
+                                     DEFAULT_CONVERTER_TIMEOUT)
+
+    # The converter gets its own process group, so that anything it starts
+    # is killed along with it if it times out
+    render_process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE,
+                                      env=converter_environment(),
+                                      start_new_session=True)
+
+    try:
+        (output, error) = render_process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(render_process.pid, signal.SIGKILL)
+        render_process.communicate()
+
+        abort(500, "Conversion of '%s' timed out after %s seconds"
+              % (path, timeout))
+
+    if render_process.returncode != 0:
+        abort(500, "Conversion of '%s' failed with error %d: %s %s"
+              % (path, render_process.returncode, output, error))
+
+    return output
+
+
+def run_pooled_converter(path, converter_bin, pool):
+    try:
+        (status, output) = pool.render(path)
+    except ConverterError as e:
+        if not pool.supported:
+            return run_converter(path, converter_bin)
+
+        abort(500, "Conversion of '%s' failed: %s" % (path, e))
+
+    if status != 0:
+        abort(500, "Conversion of '%s' failed with error %d: %s"
+              % (path, status, output))
+
+    return output
+
+
+def run_plugin(path, plugin):
+    try:
+        return plugin.render(path)
+    except (ConverterError, OSError) as e:
+        abort(500, "Conversion of '%s' by '%s' failed: %s"
+              % (path, plugin.spec, e))
+
+
+@contextlib.contextmanager
+def converter_slot(file_suffix):
+    """
+    Waits (for at most the format's timeout) until fewer than the format's
+    max_concurrency documents are being converted
+    """
+    limit = converter_limits.get(file_suffix)
+
+    if limit is None:
+        yield
+        return
+
+    if not limit.acquire(timeout=converter_timeouts[file_suffix]):
+        abort(503, "Too many documents are being converted; try again later")
+
+    try:
+        yield
+    finally:
+        limit.release()
+
+
+def convert(path, converter_bin):
+    file_suffix = os.path.splitext(path)[1]
+
+    with converter_slot(file_suffix), span("converter"):
+        if file_suffix in converter_plugins:
+            return run_plugin(path, converter_plugins[file_suffix])
+
+        pool = converter_pools.get(file_suffix)
+
+        if pool is None or not pool.supported:
+            return run_converter(path, converter_bin)
+
+        return run_pooled_converter(path, converter_bin, pool)
+
+
+def run_converter_batch(paths, converter_bin, timeout):
+    """
+    Renders paths with as few converter processes run in batch mode as
+    possible, yielding (path, output, error) for each in turn, where error is
+    None if it was rendered. If the converter times out or crashes, the
+    document it was rendering fails and a new converter is started for the
+    rest. Raises ConverterError if the converter doesn't support batch mode.
+    """
+    while len(paths) > 0:
+        worker = ConverterWorker(converter_bin, timeout, CONVERTER_BATCH_FLAG)
+        done = 0
+
+        try:
+            for (status, output) in worker.render_batch(paths, timeout):
+                if status == 0:
+                    yield (paths[done], output, None)
+                else:
+                    yield (paths[done], None,
+                           "Conversion failed with error %d: %s"
+                           % (status, output.decode("utf-8", "replace")))
+
+                done += 1
+        except ConverterError as e:
+            yield (paths[done], None, str(e))
+            done += 1
+        finally:
+            worker.kill()
+
+        paths = paths[done:]
+
+
+def render_batch(paths, procs=DEFAULT_BATCH_PROCS):
+    """
+    Renders many markup files ahead of time, storing their output in the
+    render cache and skipping those whose renders are already cached.
+
+    Documents whose converter is a binary without a converter pool are split
+    among batch mode converters, so that they're rendered by at most procs
+    converter processes rather than one process per document. Other
+    documents, and those whose converter doesn't support batch mode, are
+    rendered one at a time, procs at once. No more than a format's
+    max_concurrency documents are rendered at once; batch mode converters
+    don't take the format's max_concurrency slots, so that warming the cache
+    doesn't keep documents that are being viewed waiting until a whole batch
+    is rendered. Returns a list of the paths that were rendered and a dict
+    mapping the paths that couldn't be rendered to the reason why.
+    """
+    rendered = []
+    errors = {}
+    render_keys = {}
+    batches = collections.defaultdict(list)
+    singles = collections.defaultdict(list)
+
+    for path in paths:
+        file_suffix = os.path.splitext(path)[1]
+        converter_bin = markup_file_converter_binaries.get(file_suffix)
+
+        if converter_bin is None:
+            errors[path] = "Not a markup file"
+            continue
+
+        try:
+            render_keys[path] = render_key(path, converter_bin)
+        except OSError as e:
+            errors[path] = str(e)
+            continue
+
+        if render_cache is not None and \
+           render_cache.get(render_keys[path]) is not None:
+            continue
+
+        pool = converter_pools.get(file_suffix)
+
+        if file_suffix in converter_plugins or \
+           (pool is not None and pool.supported) or \
+           converter_bin in batch_unsupported_converters or "\n" in path:
+            singles[file_suffix].append(path)
+        else:
+            batches[file_suffix].append(path)
+
+    def store(path, output):
+        if render_cache is not None:
+            render_cache.put(render_keys[path], output)
+
+        rendered.append(path)
+
+    def render_single(path):
+        converter_bin = markup_file_converter_binaries[
+            os.path.splitext(path)[1]]
+
+        try:
+            store(path, convert(path, converter_bin))
+        except bottle.HTTPError as e:
+            errors[path] = e.body
+
+    def render_singles(file_suffix, chunk):
+        for path in chunk:
+            render_single(path)
+
+    def render_chunk(file_suffix, chunk):
+        converter_bin = markup_file_converter_binaries[file_suffix]
+        timeout = converter_timeouts.get(file_suffix,
+                                         DEFAULT_CONVERTER_TIMEOUT)
+        done = set()
+
+        try:
+            with span("converter_batch"):
+                for (path, output, error) in run_converter_batch(
+                        chunk, converter_bin, timeout):
+                    done.add(path)
+
+                    if error is None:
+                        store(path, output)
+                    else:
+                        errors[path] = error
+        except ConverterError:
+            print("'%s' doesn't support batch mode; converting documents "
+                  "one at a time" % (converter_bin))
+            batch_unsupported_converters.add(converter_bin)
+
+            for path in chunk:
+                if path not in done:
+                    render_single(path)
+        except OSError as e:
+            for path in chunk:
+                if path not in done:
+                    errors[path] = str(e)
+
+    procs = max(procs, 1)
+    futures = []
+
+    with concurrent.futures.ThreadPoolExecutor(procs) as executor:
+        for (render_function, documents) in ((render_chunk, batches),
+                                             (render_singles, singles)):
+            for (file_suffix, suffix_paths) in documents.items():
+                chunk_count = min(procs, len(suffix_paths),
+                                  converter_max_concurrency.get(file_suffix,
+                                                                procs))
+
+                futures.extend(executor.submit(
+                    render_function, file_suffix,
+                    suffix_paths[i::chunk_count])
+                    for i in range(chunk_count))
+
+        for future in futures:
+            future.result()
+
+    return (rendered, errors)
+
+
+def render_directory(path, recursive=False, procs=DEFAULT_BATCH_PROCS):
+    """
+    Renders the markup files in the directory at path (and, if recursive, in
+    its subdirectories) with render_batch()
+    """
+    if recursive:
+        paths = list(markup_files_in_subtree(path))
+    else:
+        paths = [os.path.join(path, entry["name"])
+                 for entry in list_directory(path)["entries"]
+                 if not entry["is_dir"] and os.path.splitext(
+                     entry["name"])[1] in markup_file_suffixes]
+
+    return (paths,) + render_batch(paths, procs)
+
+
+def render_key(path, converter_bin):
+    """
+    Identifies a render of the file at path: it changes whenever the file or
+    the converter used to render it changes
+    """
+    file_stat = os.stat(path)
+
+    try:
+        converter_mtime = os.stat(converter_bin).st_mtime_ns
+    except OSError:
+        converter_mtime = None
+
+    return (path, file_stat.st_mtime_ns, file_stat.st_size,
+            converter_bin, converter_mtime)
+
+
+def render_file(path):
+    """
+    Returns the converter's output for the markup file at path, re-using a
+    cached render if the file and its converter haven't changed
+    """
+    file_suffix = os.path.splitext(path)[1]
+    converter_bin = markup_file_converter_binaries[file_suffix]
+    cache_key = render_key(path, converter_bin)
+
+    if render_cache is not None:
+        output = render_cache.get(cache_key)
+
+        if output is not None:
+            return output
+
+    def render():
+        if render_cache is None:
+            return convert(path, converter_bin)
+
+        # Another request may have finished rendering the file since we
+        # checked the cache
+        output = render_cache.get(cache_key)
+
+        if output is None:
+            output = convert(path, converter_bin)
+            render_cache.put(cache_key, output)
+
+        return output
+
+    # Concurrent requests for the same unchanged file share one render
+    return render_flights.run(cache_key, render)
+
+
+def view_file(path, root):
+    file_suffix = os.path.splitext(path)[1]
+
+    if file_suffix not in markup_file_suffixes:
+        # Sent a block at a time, honoring Range requests
+        return static_file(path, root="/")
+
+    parent_dir = os.path.abspath(os.path.join(path, os.pardir))
+
+    listing = list_directory(parent_dir)
+    files_in_dir = [entry["name"] for entry in listing["entries"]]
+
+    file_index = listing["positions"].get(os.path.relpath(path, parent_dir))
+
+    def make_path_struct(filename):
+        path_dict = {
+            "name": os.path.splitext(filename)[0],
+            "link": '/'.join(("/view", os.path.relpath(parent_dir, root),
+                              filename))
+            }
+
+        return path_dict
+
+    if file_index is not None and file_index > 0:
+        prev_path = make_path_struct(files_in_dir[file_index - 1])
+    else:
+        prev_path = None
+
+    if file_index is not None and file_index < len(files_in_dir) - 1:
+        next_path = make_path_struct(files_in_dir[file_index + 1])
+    else:
+        next_path = None
+
+    file_mtime = os.path.getmtime(path)
+
+    etag = page_etag("file.jinja", root, render_key(
+        path, markup_file_converter_binaries[file_suffix]), prev_path,
+        next_path)
+    cached_page = cached_page_response(etag, file_mtime, "file", path, root)
+
+    if cached_page is not None:
+        return cached_page
+
+    filename = os.path.splitext(os.path.basename(path))[0]
+
+    parent_path = "/view/" + os.path.relpath(parent_dir, root)
+
+    if not request.environ.get(IN_PROCESS_ENVIRON_KEY) and \
+       os.path.getsize(path) >= config.getint(
+            "markupserve", "stream_min_size",
+            fallback=DEFAULT_STREAM_MIN_SIZE):
+        return stream_file_page(path, filename=filename,
+                                last_modified=file_mtime, parent=parent_path,
+                                prev=prev_path, next=next_path)
+
+    output = render_file(path)
+
+    # Get rid of any Unicode garbage that Jinja might choke on
+    output = output.decode("utf-8")
+
+    return page_response(render_template(
+        "file.jinja", filename=filename, last_modified=file_mtime,
+        content=[output],
+        parent=parent_path, prev=prev_path, next=next_path))
+
+
+def cached_render(path):
+    """
+    Returns the cached converter output for the markup file at path, or None
+    if it hasn't been rendered since it last changed
+    """
+    if render_cache is None:
+        return None
+
+    return render_cache.get(render_key(
+        path, markup_file_converter_binaries[os.path.splitext(path)[1]]))
+
+
+def streamed_document(path, output):
+    """
+    Yields the converter's output for the markup file at path as text, a
+    block at a time. If output is None, the file is converted once the
+    consumer asks for the first block, after an empty string is yielded to
+    tell stream_file_page to send what it has so far.
+    """
+    if output is None:
+        yield ""
+
+        try:
+            output = render_file(path)
+        except Exception as e:
+            # Part of the page has already been sent, so the error can only
+            # be reported in the page itself
+            if isinstance(e, bottle.HTTPError):
+                message = e.body
+            else:
+                message = "%s: %s" % (type(e).__name__, e)
+
+            print("Rendering '%s' failed: %s" % (path, message))
+            yield '<pre class="error">%s</pre>' % (html.escape(message))
+            return
+
+    decoder = codecs.getincrementaldecoder("utf-8")()
+
+    for start in range(0, len(output), STREAM_BLOCK_SIZE):
+        yield decoder.decode(output[start:start + STREAM_BLOCK_SIZE])
+
+    yield decoder.decode(b"", final=True)
+
+
+def stream_file_page(path, **context):
+    """
+    Returns an iterator over the page for a large markup file, as it's
+    generated by file.jinja, compressed if the client accepts it. The part of
+    the page before the document is sent before the document is converted,
+    and the page is never held in memory as a whole. Must be called after
+    cached_page_response.
+    """
+    output = cached_render(path)
+
+    if output is None:
+        # The status has been sent by the time the converter runs, so a
+        # failed conversion can't be reported as an error; make sure clients
+        # don't keep the page
+        del response.headers["ETag"]
+        del response.headers["Last-Modified"]
+
+    encoding = page_encoding()
+
+    if encoding == "gzip":
+        compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    elif encoding == "deflate":
+        compressor = zlib.compressobj()
+    else:
+        compressor = None
+
+    if compressor is not None:
+        response.set_header("Content-Encoding", encoding)
+
+    def encode(text, flush):
+        data = text.encode("utf-8")
+
+        if compressor is None:
+            return data
+
+        data = compressor.compress(data)
+
+        if flush:
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        return data
+
+    def generate():
+        template = jinja_env.get_template("file.jinja")
+        pending = []
+        pending_length = 0
+
+        for text in template.generate(
+                content=streamed_document(path, output), **context):
+            pending.append(text)
+            pending_length += len(text)
+
+            # An empty string asks for what's been generated so far to be
+            # sent straight away
+            if len(text) == 0 or pending_length >= STREAM_BLOCK_SIZE:
+                yield encode("".join(pending), flush=True)
+                pending = []
+                pending_length = 0
+
+        data = encode("".join(pending), flush=False)
+
+        if compressor is not None:
+            data += compressor.flush()
+
+        yield data
+
+    return generate()
+
+
+@route("/static/:filename")
+def serve_static_file(filename):
+    static_root = os.path.join(os.path.dirname(__file__), "static")
+
+    return static_file(filename, root=static_root)
+
+
+def grep_file(path, pattern, deadline):
+    """
+    Returns the lines of the file at path that match pattern, stopping early
+    if the deadline passes
+    """
+    lines = []
+
+    if time.time() > deadline:
+        return lines
+
+    try:
+        with open(path, 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                return lines
+
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as contents:
+                match = pattern.search(contents)
+
+                while match is not None and time.time() <= deadline:
+                    line_start = contents.rfind(b'\n', 0, match.start()) + 1
+                    line_end = contents.find(b'\n', match.end())
+
+                    if line_end == -1:
+                        line_end = len(contents)
+
+                    lines.append(contents[line_start:line_end].decode(
+                        "utf-8", "replace"))
+
+                    # Only report each line once
+                    match = pattern.search(contents, line_end + 1)
+    except (OSError, ValueError):
+        # File was removed or can't be read
+        pass
+
+    return lines
+
+
+def grep_search(search_terms, document_root, page, pagesize, sort_by):
+    """
+    Searches markup files for lines containing search_terms (ignoring case)
+    without an index. Files are scanned in parallel; scanning stops once
+    grep_max_hits lines have been found or grep_timeout seconds have passed.
+    """
+    pattern = re.compile(re.escape(search_terms.encode("utf-8")),
+                         re.IGNORECASE)
+
+    max_hits = config.getint("markupserve", "grep_max_hits",
+                             fallback=DEFAULT_GREP_MAX_HITS)
+    deadline = time.time() + config.getfloat(
+        "markupserve", "grep_timeout", fallback=DEFAULT_GREP_TIMEOUT)
+
+    threads = config.getint("markupserve", "grep_threads",
+                            fallback=DEFAULT_GREP_THREADS)
+
+    results = collections.defaultdict(list)
+    hits = 0
+
+    # Files are submitted as the tree is walked, with only a few more in
+    # flight than there are threads, so that walking stops as soon as
+    # enough hits have been found or time has run out
+    files = markup_files_in_subtree(document_root)
+    futures = {}
+    walking = True
+
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        while hits < max_hits and time.time() <= deadline:
+            while walking and len(futures) < GREP_FILES_IN_FLIGHT * threads:
+                file_abspath = next(files, None)
+
+                if file_abspath is None:
+                    walking = False
+                else:
+                    futures[executor.submit(
+                        grep_file, file_abspath, pattern, deadline)] = \
+                        file_abspath
+
+            if len(futures) == 0:
+                break
+
+            done, _ = concurrent.futures.wait(
+                futures, timeout=max(deadline - time.time(), 0),
+                return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in done:
+                file_abspath = futures.pop(future)
+                lines = future.result()[:max_hits - hits]
+
+                if len(lines) > 0:
+                    filename = os.path.relpath(file_abspath, document_root)
+                    results[filename].extend(lines)
+                    hits += len(lines)
+
+        for pending_future in futures:
+            pending_future.cancel()
+
+    return paginate_results(results, document_root, page, pagesize, sort_by)
+
+
+def paginate_results(results, document_root, page, pagesize, sort_by):
+    """
+    Returns the given page of a dict of search results (or the last page, if
+    there are fewer pages), the total number of files in the results and the
+    number of the page returned
+    """
+    # Files are found in whatever order the threads scanning them finish,
+    # and there's no relevance to rank them by, so they're sorted by path
+    # unless another order is asked for to keep pages stable
+    filenames = sorted(results.keys())
+
+    if sort_by == "mtime":
+        filenames.sort(key=lambda x: os.path.getmtime(
+            os.path.join(document_root, x)), reverse=True)
+
+    # Clamped like whoosh clamps pages of indexed results
+    page = max(min(page, (len(filenames) + pagesize - 1) // pagesize), 1)
+
+    page_filenames = filenames[(page - 1) * pagesize:page * pagesize]
+
+    page_results = collections.OrderedDict(
+        (filename, results[filename]) for filename in page_filenames)
+
+    return (page_results, len(filenames), page)
+
+
+def read_document_text(path):
+    try:
+        with open(path, 'rb') as fp:
+            return fp.read().decode("utf-8", "replace")
+    except OSError:
+        # File has been removed since it was indexed
+        return ""
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_search_query(search_terms, fields):
+    """
+    Parses search terms into a query over the given fields of the index
+    """
+    from whoosh.qparser import MultifieldParser
+
+    qp = MultifieldParser(fields, schema=markupserve_index.schema,
+                          fieldboosts=SEARCH_FIELD_BOOSTS)
+
+    return qp.parse(safe_unicode(search_terms))
+
+
+def index_search(search_terms, document_root, page, pagesize, sort_by):
+    from whoosh import sorting
+
+    search_terms = " ".join(search_terms.split())
+
+    # Terms are looked for in each document's title and headings as well as
+    # its content, unless a field is given (e.g. 'headings:install')
+    fields = tuple(field for field in SEARCH_FIELD_BOOSTS
+                   if field in markupserve_index.schema)
+
+    query = parse_search_query(search_terms, fields)
+
+    if sort_by == "path":
+        sortedby = "path"
+    elif sort_by == "mtime":
+        sortedby = sorting.StoredFieldFacet("mtime")
+    else:
+        # Sort by relevance
+        sortedby = None
+
+    results = collections.OrderedDict()
+
+    with search_cache.searcher(markupserve_index) as searcher:
+        cache_key = (search_terms, page, pagesize, sort_by,
+                     searcher.reader().generation())
+
+        cached_results = search_cache.get(cache_key)
+
+        if cached_results is not None:
+            return cached_results
+
+        # Only the hits on the requested page are loaded and highlighted
+        with span("whoosh_search"):
+            query_results = searcher.search_page(
+                query, page, pagelen=pagesize, sortedby=sortedby,
+                reverse=(sort_by == "mtime"))
+
+        query_results.results.fragmenter.maxchars = config.getint(
+            "markupserve", "search_fragment_chars",
+            fallback=DEFAULT_SEARCH_FRAGMENT_CHARS)
+
+        fragments = config.getint("markupserve", "search_fragments",
+                                  fallback=DEFAULT_SEARCH_FRAGMENTS)
+
+        with span("search_highlight"):
+            for result in query_results:
+                highlights = result.highlights(
+                    "content", text=indexed_document_text(
+                        os.path.join(document_root, result["path"])),
+                    top=fragments)
+
+                # Documents that only match on their title or headings have
+                # nothing in their content to highlight
+                results[result["path"]] = \
+                    [highlights] if len(highlights) > 0 else []
+
+        total_hits = query_results.total
+
+        # whoosh returns the last page for pages past the end of the results
+        page = query_results.pagenum
+
+    search_cache.put(cache_key, (results, total_hits, page))
+
+    return (results, total_hits, page)
+
+
+@route("/search")
+def search():
+    """
+    Searches the document root. Results are returned a page at a time,
+    controlled by the 'page' and 'pagesize' parameters, and may be sorted by
+    'path' or 'mtime' using the 'sort' parameter (the default is to sort by
+    relevance).
+    """
+    search_terms = request.GET.dict["terms"][0]
+
+    try:
+        page = max(int(request.GET.get("page", 1)), 1)
+        pagesize = max(int(request.GET.get(
+            "pagesize", config.getint("markupserve", "search_page_size",
+                                      fallback=DEFAULT_SEARCH_PAGE_SIZE))), 1)
+    except ValueError:
+        abort(400, "'page' and 'pagesize' must be integers")
+
+    sort_by = request.GET.get("sort")
+
+    if sort_by not in SEARCH_SORT_KEYS:
+        sort_by = None
+
+    document_root = os.path.expanduser(config.get(
+        "markupserve", "document_root"))
+
+    if markupserve_index is None:
+        search_function = grep_search
+    else:
+        search_function = index_search
+
+    with span(search_function.__name__):
+        (results, total_hits, page) = search_function(
+            search_terms, document_root, page, pagesize, sort_by)
+
+    return render_template("search.jinja", terms=search_terms,
+                           results=results, total_hits=total_hits, page=page,
+                           pagesize=pagesize, sort_by=sort_by,
+                           page_count=(total_hits + pagesize - 1) // pagesize)
+
+
+def int_param(name):
+    """
+    Returns the value of the named request parameter as an int, or None if
+    it isn't given or isn't a number
+    """
+    try:
+        return int(request.GET[name])
+    except (KeyError, ValueError):
+        return None
+
+
+@route("/view/:path#.+#")
+def view(path):
+    """
+    Handles the viewing of a file
+    """
+
+    if "sorted_by" in request.GET.dict:
+        sorted_by = request.GET.dict["sorted_by"][0]
+    else:
+        sorted_by = None
+
+    reverse = "reverse" in request.GET and (
+        int(request.GET.dict["reverse"][0]) == 1)
+
+    document_root = os.path.expanduser(config.get("markupserve", "document_root"))
+
+    absolute_path = os.path.abspath(document_root + "/" + path)
+
+    if not os.path.exists(absolute_path):
+        abort(404, "The path '%s' couldn't be found" % (absolute_path))
+
+    if os.path.isdir(absolute_path):
+        if path != "/":
+            parent_path = os.path.abspath(absolute_path + "/" + os.pardir)
+        else:
+            parent_path = None
+
+        dir_config = load_dir_config(absolute_path,
+                                     list_directory(absolute_path))
+
+        if dir_config is not None and dir_config["style"] == "calendar":
+            return view_calendar(absolute_path, parent_path, document_root,
+                                 dir_config, int_param("year"),
+                                 int_param("month"),
+                                 request.GET.get("year") == "all")
+
+        return view_dir(absolute_path, parent_path, document_root,
+                        sorted_by, reverse)
+    else:
+        return view_file(absolute_path, document_root)
+
+
+@route("/")
+@route("/view/")
+def view_index():
+    return view("/")
+
+
+class RenderedTextExtractor(html.parser.HTMLParser):
+    """
+    Collects the text of a converter's HTML output, leaving out scripts and
+    stylesheets, along with the text of its headings
+    """
+
+    HEADING_TAGS = frozenset(("h1", "h2", "h3", "h4", "h5", "h6"))
+    SKIPPED_TAGS = frozenset(("script", "style"))
+    # Tags that don't separate the words on either side of them
+    INLINE_TAGS = frozenset(("a", "abbr", "b", "code", "em", "i", "kbd",
+                             "mark", "s", "small", "span", "strong", "sub",
+                             "sup", "u"))
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.text = []
+        self.headings = []
+        self.skip_depth = 0
+        self.heading_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED_TAGS:
+            self.skip_depth += 1
+        elif tag in self.HEADING_TAGS:
+            self.heading_depth += 1
+            self.headings.append("\n")
+
+        if tag not in self.INLINE_TAGS:
+            self.text.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED_TAGS:
+            self.skip_depth = max(self.skip_depth - 1, 0)
+        elif tag in self.HEADING_TAGS:
+            self.heading_depth = max(self.heading_depth - 1, 0)
+
+        if tag not in self.INLINE_TAGS:
+            self.text.append("\n")
+
+    def handle_data(self, data):
+        if self.skip_depth > 0:
+            return
+
+        self.text.append(data)
+
+        if self.heading_depth > 0:
+            self.headings.append(data)
+
+
+def rendered_text(output):
+    """
+    Returns the text of a converter's output and the text of its headings
+    """
+    extractor = RenderedTextExtractor()
+    extractor.feed(output.decode("utf-8", "replace"))
+    extractor.close()
+
+    return ("".join(extractor.text), "".join(extractor.headings))
+
+
+def rendered_document_text(path):
+    """
+    Renders the markup file at path (re-using its cached render if there is
+    one) and returns its text and the text of its headings, or None if it
+    can't be rendered
+    """
+    try:
+        output = render_file(path)
+    except bottle.HTTPError as e:
+        print("Can't render '%s' for indexing; indexing its markup instead: "
+              "%s" % (path, e.body))
+        return None
+
+    return rendered_text(output)
+
+
+def indexed_document_text(path):
+    """
+    Returns the text of the markup file at path to highlight search results
+    in. Rendered text is only used if the document's render is cached, so
+    that searching never waits for a converter.
+    """
+    if index_rendered_text:
+        try:
+            output = cached_render(path)
+        except OSError:
+            # File has been removed since it was indexed
+            output = None
+
+        if output is not None:
+            return rendered_text(output)[0]
+
+    return read_document_text(path)
+
+
+def content_source():
+    return "rendered" if index_rendered_text else "markup"
+
+
+def hash_file_contents(contents):
+    return hashlib.md5(contents).hexdigest()
+
+
+def hash_file(path):
+    """
+    Returns the same hash as hash_file_contents, reading the file a block at
+    a time
+    """
+    file_hash = hashlib.md5()
+
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(FILE_READ_BLOCK_SIZE), b''):
+            file_hash.update(block)
+
+    return file_hash.hexdigest()
+
+
+def file_stat_fields(file_stat):
+    return {
+        "mtime": file_stat.st_mtime_ns,
+        "size": file_stat.st_size,
+        "inode": file_stat.st_ino
+        }
+
+
+def add_file_to_index(filename, document_root, writer):
+    file_basename = os.path.basename(filename)
+
+    filename_root = os.path.splitext(file_basename)[0]
+
+    # Stat before reading so that a file modified mid-read looks changed the
+    # next time the index is updated
+    file_stat = os.stat(filename)
+
+    with open(filename, 'rb') as fp:
+        file_contents = fp.read()
+
+    file_hash = hash_file_contents(file_contents)
+
+    text = rendered_document_text(filename) if index_rendered_text else None
+
+    if text is None:
+        (content, headings) = (file_contents.decode("utf-8", "replace"), "")
+    else:
+        (content, headings) = text
+
+    writer.add_document(
+        title=safe_unicode(filename_root),
+        content=content,
+        headings=headings,
+        # Documents that can't be rendered are recorded as indexed in the
+        # current mode anyway, so that they aren't retried on every update
+        content_source=content_source(),
+        file_hash=safe_unicode(file_hash),
+        path=safe_unicode(
+            os.path.relpath(filename, document_root)),
+        **file_stat_fields(file_stat))
+
+
+def remove_file_from_index(filename, document_root, writer):
+    writer.delete_by_term(
+        'path', safe_unicode(os.path.relpath(filename, document_root)))
+
+
+def reindex_file(filename, document_root, writer):
+    """
+    Replaces any indexed copies of a file with its current contents. If the
+    file can't be indexed (because it no longer exists, or can't be read)
+    its copies are just removed and the OSError raised is returned;
+    otherwise returns None.
+    """
+    remove_file_from_index(filename, document_root, writer)
+
+    try:
+        add_file_to_index(filename, document_root, writer)
+    except OSError as e:
+        return e
+
+    return None
+
+
+def invalidate_caches(path):
+    """
+    Drops anything cached about the file at path, which has just changed
+    """
+    if render_cache is not None:
+        render_cache.invalidate(path)
+
+    if dir_cache is not None:
+        dir_cache.invalidate(os.path.dirname(path))
+
+
+def markup_files_in_subtree(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            extension = os.path.splitext(filename)[1]
+
+            if extension not in markup_file_suffixes:
+                continue
+            else:
+                yield os.path.join(dirpath, filename)
+
+
+def build_index(writer, progress=None):
+    document_root = os.path.expanduser(config.get(
+        "markupserve", "document_root"))
+
+    if progress is None:
+        progress = collections.Counter()
+
+    start_time = time.time()
+    files_indexed = 0
+
+    for file_abspath in markup_files_in_subtree(document_root):
+        progress["scanned"] += 1
+
+        try:
+            add_file_to_index(file_abspath, document_root, writer)
+        except OSError as e:
+            skip_unindexable_file(file_abspath, e, progress)
+            continue
+
+        files_indexed += 1
+        progress["added"] += 1
+
+        if files_indexed % INDEX_PROGRESS_INTERVAL == 0:
+            print("Indexed %d files (%.1f files/sec)" % (
+                files_indexed, files_indexed / (time.time() - start_time)))
+
+    return files_indexed
+
+
+def populate_index(markupserve_index, procs=1, clear=False, job=None):
+    """
+    Adds every markup file to a new index, or replaces the contents of an
+    existing one if clear is True. If procs is greater than 1, documents are
+    analyzed by that many processes using whoosh's multiprocessing writer
+    and their segments committed together.
+    """
+    from whoosh import writing
+
+    if procs > 1:
+        writer = markupserve_index.writer(procs=procs, multisegment=True)
+    else:
+        writer = markupserve_index.writer()
+
+    start_time = time.time()
+
+    if job is not None:
+        job.set_phase("indexing")
+
+    try:
+        with span("index_build"):
+            files_indexed = build_index(writer, job and job.progress)
+
+        if job is not None:
+            job.set_phase("committing")
+
+        with span("index_commit"):
+            if clear:
+                writer.commit(mergetype=writing.CLEAR)
+            else:
+                writer.commit()
+    except BaseException:
+        # Release the write lock so that a later build or update can run
+        writer.cancel()
+        raise
+
+    search_cache.invalidate()
+
+    elapsed = time.time() - start_time
+
+    print("Indexed %d files in %.2f seconds (%.1f files/sec) using %d "
+          "process(es)" % (files_indexed, elapsed,
+                           files_indexed / max(elapsed, 1e-6), procs))
+
+
+def plan_index_update(document_root, searcher, progress=None):
+    """
+    Compares the index against the markup files under document_root.
+
+    Files whose mtime, size and inode haven't changed since they were indexed
+    are assumed to be unchanged and aren't read. Other indexed files are
+    hashed; those whose contents changed are 'changed', and those whose
+    contents are the same are 'touched' (they're re-indexed anyway so that
+    their new stat is recorded). Files indexed from their markup when
+    index_rendered_text is set, or vice versa, are also 'touched', without
+    being hashed. Returns a dict of the paths in each category along with
+    per-phase timings; files are read again when the plan is applied, so
+    that the plan doesn't hold their contents.
+    """
+    plan = {
+        "added": [],
+        "changed": [],
+        "touched": [],
+        "removed": [],
+        "unchanged": 0,
+        "timings": {}
+        }
+
+    indexed_paths = set()
+
+    if progress is None:
+        progress = collections.Counter()
+
+    start_time = time.time()
+
+    duplicate_paths = set()
+
+    for fields in searcher.all_stored_fields():
+        indexed_path = os.path.join(document_root, fields["path"])
+
+        if indexed_path in indexed_paths:
+            duplicate_paths.add(indexed_path)
+            continue
+
+        indexed_paths.add(indexed_path)
+        progress["scanned"] += 1
+
+        try:
+            file_stat = os.stat(indexed_path)
+        except FileNotFoundError:
+            # File was deleted since we last updated the index
+            plan["removed"].append(indexed_path)
+            continue
+        except OSError:
+            # File can't be read (e.g. a symlink loop); re-indexing it drops
+            # its stale entry and counts it as skipped
+            plan["changed"].append(indexed_path)
+            continue
+
+        stored_stat = dict((field, fields.get(field)) for field in
+                           ("mtime", "size", "inode"))
+
+        if fields.get("content_source", "markup") != content_source():
+            plan["touched"].append(indexed_path)
+            continue
+
+        if stored_stat == file_stat_fields(file_stat):
+            plan["unchanged"] += 1
+            continue
+
+        # Stat has changed; check whether the contents have too
+        try:
+            file_hash = hash_file(indexed_path)
+        except FileNotFoundError:
+            plan["removed"].append(indexed_path)
+            continue
+        except OSError:
+            plan["changed"].append(indexed_path)
+            continue
+
+        if file_hash != fields["file_hash"]:
+            plan["changed"].append(indexed_path)
+        else:
+            plan["touched"].append(indexed_path)
+
+    # Files indexed more than once (by updates that raced with the watcher
+    # in older versions) are re-indexed so that only one copy is left
+    for indexed_path in duplicate_paths - set(plan["removed"]) - \
+            set(plan["changed"]) - set(plan["touched"]):
+        plan["unchanged"] -= 1
+        plan["changed"].append(indexed_path)
+
+    plan["timings"]["check_indexed"] = time.time() - start_time
+
+    start_time = time.time()
+
+    for file_abspath in markup_files_in_subtree(document_root):
+        if file_abspath not in indexed_paths:
+            progress["scanned"] += 1
+            plan["added"].append(file_abspath)
+
+    plan["timings"]["find_added"] = time.time() - start_time
+
+    return plan
+
+
+def skip_unindexable_file(file_abspath, error, progress):
+    print("Can't index '%s': %r" % (file_abspath, error))
+    progress["skipped"] += 1
+
+
+def apply_index_update(plan, document_root, writer, progress=None):
+    if progress is None:
+        progress = collections.Counter()
+
+    start_time = time.time()
+
+    for file_abspath in plan["removed"]:
+        remove_file_from_index(file_abspath, document_root, writer)
+        progress["removed"] += 1
+
+    # Files may have been removed since the plan was made, and the watcher
+    # may have indexed added files, so every file is replaced rather than
+    # just added
+    for file_abspath in plan["changed"] + plan["touched"]:
+        error = reindex_file(file_abspath, document_root, writer)
+
+        if error is None:
+            progress["updated"] += 1
+        elif isinstance(error, FileNotFoundError):
+            progress["removed"] += 1
+        else:
+            skip_unindexable_file(file_abspath, error, progress)
+
+    for file_abspath in plan["added"]:
+        error = reindex_file(file_abspath, document_root, writer)
+
+        if error is None:
+            progress["added"] += 1
+        elif not isinstance(error, FileNotFoundError):
+            skip_unindexable_file(file_abspath, error, progress)
+
+    plan["timings"]["apply"] = time.time() - start_time
+
+
+def index_update_report(plan):
+    report = {
+        "unchanged": plan["unchanged"],
+        "timings": plan["timings"]
+        }
+
+    for category in ("added", "changed", "touched", "removed"):
+        report[category] = len(plan[category])
+
+    return report
+
+
+def run_index_update(job):
+    document_root = os.path.expanduser(config.get(
+        "markupserve", "document_root"))
+
+    # The plan is made with the write lock held, so that the watcher can't
+    # commit changes that it doesn't account for before it's applied
+    with index_write_lock:
+        job.set_phase("scanning")
+
+        with span("index_scan"), markupserve_index.searcher() as searcher:
+            plan = plan_index_update(document_root, searcher, job.progress)
+
+        job.set_phase("indexing")
+
+        writer = markupserve_index.writer()
+
+        try:
+            with span("index_apply"):
+                apply_index_update(plan, document_root, writer, job.progress)
+
+            job.set_phase("committing")
+
+            start_time = time.time()
+
+            with span("index_commit"):
+                writer.commit()
+        except BaseException:
+            writer.cancel()
+            raise
+
+        search_cache.invalidate()
+
+        plan["timings"]["commit"] = time.time() - start_time
+
+    for file_abspath in plan["changed"] + plan["removed"]:
+        invalidate_caches(file_abspath)
+
+    print("Index updated: %s" % (index_update_report(plan)))
+
+
+def run_index_rebuild(job):
+    with index_write_lock:
+        populate_index(markupserve_index, config.getint(
+            "markupserve", "index_procs", fallback=1), clear=True, job=job)
+
+
+@post("/update_index")
+def update_index():
+    """
+    Starts bringing the index up to date with the document root in the
+    background; progress is reported by /index_status. If the 'dry_run'
+    parameter is 1, nothing is changed and a report of what would have been
+    updated is returned instead.
+    """
+    document_root = os.path.expanduser(config.get(
+        "markupserve", "document_root"))
+
+    dry_run = request.params.get("dry_run") == "1"
+
+    if markupserve_index is None:
+        print("No index found; aborting update")
+        redirect('/')
+
+    if dry_run:
+        with markupserve_index.searcher() as searcher:
+            return index_update_report(
+                plan_index_update(document_root, searcher))
+
+    index_job.start("update", run_index_update)
+
+    redirect('/')
+
+
+@post("/rebuild_index")
+def rebuild_index():
+    """
+    Starts re-indexing every file in the document root from scratch in the
+    background
+    """
+    if markupserve_index is None:
+        print("No index found; aborting rebuild")
+        redirect('/')
+
+    index_job.start("rebuild", run_index_rebuild)
+
+    redirect('/')
+
+
+@post("/render_batch")
+def render_batch_route():
+    """
+    Renders the markup files in the directory given by the 'path' parameter
+    (relative to the document root, and including its subdirectories if the
+    'recursive' parameter is 1) ahead of time, using at most 'procs'
+    converter processes (no more than max_batch_procs), so that viewing them
+    doesn't wait for a converter.
+    Returns how many were rendered and how many were already cached, along
+    with any errors.
+    """
+    document_root = os.path.expanduser(config.get(
+        "markupserve", "document_root"))
+    path = os.path.normpath(os.path.join(
+        document_root, request.params.get("path", "").lstrip("/")))
+
+    if os.path.commonpath([path, document_root]) != \
+       os.path.normpath(document_root) or not os.path.isdir(path):
+        abort(404, "No directory named '%s'" % (request.params.get("path")))
+
+    max_procs = config.getint("markupserve", "max_batch_procs",
+                              fallback=DEFAULT_BATCH_PROCS)
+
+    try:
+        procs = min(max(int(request.params.get("procs", max_procs)), 1),
+                    max_procs)
+    except ValueError:
+        abort(400, "'procs' must be a number")
+
+    start_time = time.time()
+
+    (paths, rendered, errors) = render_directory(
+        path, request.params.get("recursive") == "1", procs)
+
+    return {
+        "documents": len(paths),
+        "rendered": len(rendered),
+        "cached": len(paths) - len(rendered) - len(errors),
+        "errors": dict((file_path_to_server_path(error_path, document_root),
+                        error) for (error_path, error) in errors.items()),
+        "seconds": time.time() - start_time
+        }
+
+
+@route("/index_status")
+def index_status():
+    return index_job.status()
+
+
+@route("/watch_status")
+def watch_status():
+    if index_watcher is None:
+        return {"enabled": False}
+
+    status = index_watcher.status()
+    status["enabled"] = True
+
+    return status
+
+
+def time_requests(callback):
+    """
+    Bottle plugin that records how long each route takes to handle requests
+    in /metrics, and logs requests that take longer than
+    slow_request_threshold seconds along with the spans they spent it in
+    """
+    @functools.wraps(callback)
+    def wrapper(*args, **kwargs):
+        request_timings.spans = []
+        start_time = time.perf_counter()
+
+        try:
+            return callback(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start_time
+
+            metrics.observe("markupserve_request_duration_seconds",
+                            (("method", request.method),
+                             ("route", request.route.rule)), elapsed)
+
+            if slow_request_threshold > 0 and \
+               elapsed >= slow_request_threshold:
+                print("Slow request: %s %s took %.3fs (%s)" % (
+                    request.method, request.fullpath, elapsed,
+                    ", ".join("%s %.3fs" % request_span
+                              for request_span in request_timings.spans)))
+
+            request_timings.spans = None
+
+    return wrapper
+
+
+bottle.install(time_requests)
+
+
+def metric_family_lines(samples):
+    """
+    Formats (name, type, labels, value) samples in Prometheus' text format,
+    grouped by metric
+    """
+    lines = []
+    last_name = None
+
+    for (name, metric_type, labels, value) in sorted(
+            samples, key=lambda sample: sample[0]):
+        if name != last_name:
+            lines.append("# TYPE %s %s" % (name, metric_type))
+            last_name = name
+
+        lines.append(metric_line(name, labels, value))
+
+    return lines
+
+
+def cache_metric_samples():
+    samples = []
+
+    for (name, cache) in (("render", render_cache), ("page", page_cache),
+                          ("dir", dir_cache), ("search", search_cache)):
+        if cache is None:
+            continue
+
+        labels = (("cache", name),)
+        lookups = cache.hits + cache.misses
+
+        samples.extend([
+            ("markupserve_cache_hits_total", "counter", labels, cache.hits),
+            ("markupserve_cache_misses_total", "counter", labels,
+             cache.misses),
+            ("markupserve_cache_hit_ratio", "gauge", labels,
+             cache.hits / lookups if lookups > 0 else 0)])
+
+    return samples
+
+
+def converter_metric_samples():
+    samples = []
+
+    for pool in set(converter_pools.values()):
+        labels = (("converter", pool.converter_bin),)
+
+        samples.extend([
+            ("markupserve_converter_pool_size", "gauge", labels, pool.size),
+            ("markupserve_converter_busy_workers", "gauge", labels,
+             pool.busy_workers),
+            ("markupserve_converter_idle_workers", "gauge", labels,
+             len(pool.idle_workers)),
+            ("markupserve_converter_workers_started_total", "counter",
+             labels, pool.workers_started),
+            ("markupserve_converter_renders_total", "counter", labels,
+             pool.renders),
+            ("markupserve_converter_failures_total", "counter", labels,
+             pool.failures)])
+
+    for plugin in set(converter_plugins.values()):
+        labels = (("converter", plugin.spec),)
+
+        samples.extend([
+            ("markupserve_converter_pool_size", "gauge", labels,
+             plugin.pool_size),
+            ("markupserve_converter_renders_total", "counter", labels,
+             plugin.renders),
+            ("markupserve_converter_failures_total", "counter", labels,
+             plugin.failures)])
+
+    return samples
+
+
+@route("/metrics")
+def metrics_page():
+    """
+    Reports request and span durations, cache hit ratios and converter pool
+    statistics in Prometheus' text format
+    """
+    samples = cache_metric_samples() + converter_metric_samples()
+
+    if render_flights is not None:
+        samples.append(("markupserve_renders_coalesced_total", "counter", (),
+                        render_flights.coalesced))
+
+    if index_watcher is not None:
+        samples.append(("markupserve_index_watcher_queue_depth", "gauge", (),
+                        index_watcher.status()["queue_depth"]))
+
+    lines = metrics.exposition() + metric_family_lines(samples)
+
+    response.content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+    return "\n".join(lines) + "\n"
+
+
+def uncovered_suffixes(comma_delimited_suffix_list):
+    suffixes = comma_delimited_suffix_list.split(',')
+    suffixes = [x.strip() for x in suffixes]
+    # Don't add a converter for a format that's already been covered
+    return [x for x in suffixes if x not in markup_file_suffixes]
+
+
+def add_converter(converter_binary, comma_delimited_suffix_list):
+    suffixes = uncovered_suffixes(comma_delimited_suffix_list)
+
+    if len(suffixes) == 0:
+        return suffixes
+
+    # Rewrite the location of the converter binary if its exact location isn't given
+    # but it's in our PATH
+    if not os.path.exists(converter_binary):
+        resolved_binary = find_program(converter_binary)
+
+        if resolved_binary is not None:
+            converter_binary = resolved_binary
         else:
-            # Index doesn't exist; create it
-            print("Creating index at '%s'" % (index_root))
+            exit("Can't find converter binary '%s'" % (converter_binary))
+
+    print("Adding converter '%s' for formats %s" % (converter_binary, suffixes))
+
+    for suffix in suffixes:
+        markup_file_suffixes.add(suffix)
+        markup_file_converter_binaries[suffix] = converter_binary
+
+    return suffixes
+
+
+def add_converter_module(config, section):
+    suffixes = uncovered_suffixes(config.get(section, "suffixes"))
+
+    if len(suffixes) == 0:
+        return suffixes
+
+    try:
+        plugin = ConverterPlugin(
+            config.get(section, "module"),
+            config.get(section, "pool_type", fallback="thread"),
+            config.getint(section, "pool_size", fallback=None),
+            config.getfloat(section, "timeout",
+                            fallback=DEFAULT_CONVERTER_TIMEOUT))
+    except ConverterError as e:
+        exit("Can't load converter module for section '%s': %s" %
+             (section, e))
+
+    atexit.register(plugin.shutdown)
+
+    print("Adding converter module '%s' for formats %s" % (plugin.spec,
+                                                            suffixes))
+
+    for suffix in suffixes:
+        markup_file_suffixes.add(suffix)
+        # The module's source file identifies the converter in the render
+        # cache
+        markup_file_converter_binaries[suffix] = plugin.source_path
+        converter_plugins[suffix] = plugin
+
+    return suffixes
+
+
+def add_converter_pool(config, section, suffixes):
+    pool_size = config.getint(section, "pool_size", fallback=0)
+
+    if pool_size <= 0 or len(suffixes) == 0:
+        return
+
+    pool = ConverterPool(
+        markup_file_converter_binaries[suffixes[0]], pool_size,
+        config.getfloat(section, "timeout",
+                        fallback=DEFAULT_CONVERTER_TIMEOUT),
+        config.getint(section, "max_requests",
+                      fallback=DEFAULT_CONVERTER_MAX_REQUESTS))
+
+    atexit.register(pool.shutdown)
+
+    for suffix in suffixes:
+        converter_pools[suffix] = pool
+
+
+def add_converter_limits(config, section, suffixes):
+    timeout = config.getfloat(section, "timeout",
+                              fallback=DEFAULT_CONVERTER_TIMEOUT)
+    max_concurrency = config.getint(section, "max_concurrency", fallback=0)
+
+    if max_concurrency > 0:
+        # Shared by all of the format's suffixes
+        limit = threading.BoundedSemaphore(max_concurrency)
+    else:
+        limit = None
+
+    for suffix in suffixes:
+        converter_timeouts[suffix] = timeout
+
+        if limit is not None:
+            converter_limits[suffix] = limit
+            converter_max_concurrency[suffix] = max_concurrency
+
+
+def upgrade_index_schema(markupserve_index):
+    """
+    Adds any fields that have been added to markupserve_schema() since the
+    index was created. Documents indexed without them will be re-hashed on
+    the next update.
+    """
+    missing_fields = [(name, field) for (name, field) in
+                      markupserve_schema().items()
+                      if name not in markupserve_index.schema]
 
-            os.makedirs(index_root)
+    if len(missing_fields) == 0:
+        return
+
+    writer = markupserve_index.writer()
+
+    for (name, field) in missing_fields:
+        print("Adding field '%s' to index" % (name))
+        writer.add_field(name, field)
+
+    writer.commit()
+
+
+def index_stores_content(markupserve_index):
+    return markupserve_index.schema["content"].stored
+
+
+def open_index(job, primary=True):
+    """
+    Opens the index at index_root, creating and populating it if it doesn't
+    exist, then starts the watcher if there is one. Run as an index job so
+    that the server can start taking requests straight away; searches scan
+    markup files directly until the index is ready.
+
+    When serving with several worker processes, only the primary worker
+    creates the index and watches for changes; the others wait for it to be
+    ready before opening it.
+    """
+    global markupserve_index
+
+    from whoosh import index
+
+    if not primary and index_ready_event is not None:
+        job.set_phase("waiting")
+        index_ready_event.wait()
 
-            markupserve_index = index.create_in(
-                index_root, MarkupServeSchema)
+    job.set_phase("opening")
 
-            print("Populating the index ...")
+    loaded_index = None
+
+    if os.path.isdir(index_root):
+        print("Loading index at '%s'" % (index_root))
+        # Index exists; load it
+        loaded_index = index.open_dir(index_root)
+
+        if index_stores_content(loaded_index):
+            # Indexes created by older versions store every document's
+            # content; they have to be rebuilt to drop it
+            print("Index at '%s' stores document content; rebuilding it"
+                  % (index_root))
+            loaded_index = None
+        else:
             try:
-                writer = markupserve_index.writer()
-                build_index(writer)
-                writer.commit()
-            except whoosh.store.LockError:
-                print("Index is locked; aborting ...")
+                upgrade_index_schema(loaded_index)
+            except index.LockError:
+                print("Index is locked; can't upgrade its schema")
+
+    if loaded_index is None:
+        # Index doesn't exist; create it
+        print("Creating index at '%s'" % (index_root))
+
+        os.makedirs(index_root, exist_ok=True)
+
+        loaded_index = index.create_in(index_root, markupserve_schema())
+
+        print("Populating the index ...")
+        try:
+            populate_index(loaded_index, config.getint(
+                "markupserve", "index_procs", fallback=1), job=job)
+        except index.LockError:
+            print("Index is locked; aborting ...")
+
+    markupserve_index = loaded_index
+
+    if primary:
+        if index_ready_event is not None:
+            index_ready_event.set()
+
+        if index_watcher is not None:
+            index_watcher.start()
+
+    print("Index at '%s' is ready" % (index_root))
+
+
+def parse_config(config):
+    global port, render_cache, page_cache, dir_cache, index_root, \
+        index_watcher, index_job, index_write_lock, prebuilt_root, \
+        prebuilt_manifest, slow_request_threshold, render_flights, \
+        index_rendered_text, search_cache, metrics, request_timings, \
+        dir_configs_lock
+
+    required_config_present = (
+        config.has_section("markupserve") and
+        config.has_option("markupserve", "document_root") and
+        config.has_option("markupserve", "port"))
+
+    if not required_config_present:
+        exit("MarkupServe's configuration requires a [markupserve] section "
+             "with options 'document_root' and 'port' defined")
+
+    metrics = Metrics()
+    request_timings = threading.local()
+    dir_configs_lock = threading.Lock()
+
+    # Legacy support: install markup suffixes and converter
+    if config.has_option("markupserve", "markup_suffixes") and \
+       config.has_option("markupserve", "converter_binary"):
+
+        add_converter(config.get("markupserve", "converter_binary"),
+                      config.get("markupserve", "markup_suffixes"))
+
+    # Add a converter for each config section available
+    for section in config.sections():
+        if section.startswith("format:"):
+            formatter_config_present = (
+                config.has_option(section, "suffixes") and
+                (config.has_option(section, "binary") or
+                 config.has_option(section, "module")))
+
+            if not formatter_config_present:
+                exit("Section '%s' must define 'suffixes' and either 'binary' or 'module' options" % (section))
+
+            if config.has_option(section, "module"):
+                suffixes = add_converter_module(config, section)
+            else:
+                suffixes = add_converter(config.get(section, 'binary'),
+                                         config.get(section, 'suffixes'))
+                add_converter_pool(config, section, suffixes)
+
+            add_converter_limits(config, section, suffixes)
+
+    if len(markup_file_suffixes) == 0:
+        exit("Must supply at least one file suffix to parse in config")
+
+    port = config.getint("markupserve", "port")
+
+    render_cache_size = config.getint("markupserve", "render_cache_size",
+                                      fallback=DEFAULT_RENDER_CACHE_SIZE)
+
+    if config.has_option("markupserve", "cache_root"):
+        cache_root = os.path.expanduser(
+            config.get("markupserve", "cache_root"))
+    else:
+        cache_root = None
+
+    cache_root_size = config.getint("markupserve", "cache_root_size",
+                                    fallback=DEFAULT_CACHE_ROOT_SIZE)
+
+    if render_cache_size > 0:
+        render_cache = RenderCache(render_cache_size, cache_root,
+                                   cache_root_size)
+
+    page_cache_size = config.getint("markupserve", "page_cache_size",
+                                    fallback=DEFAULT_PAGE_CACHE_SIZE)
+
+    if page_cache_size > 0:
+        # Compressed pages are kept apart from rendered HTML, so that each
+        # gets its own share of cache_root_size
+        page_cache = RenderCache(
+            page_cache_size,
+            cache_root and os.path.join(cache_root, "pages"),
+            cache_root_size)
+
+    dir_cache_size = config.getint("markupserve", "dir_cache_size",
+                                   fallback=DEFAULT_DIR_CACHE_SIZE)
+
+    if dir_cache_size > 0:
+        dir_cache = DirectoryCache(
+            dir_cache_size, config.getfloat(
+                "markupserve", "dir_cache_max_age",
+                fallback=DEFAULT_DIR_CACHE_MAX_AGE))
+
+    if config.has_option("markupserve", "prebuilt_root"):
+        prebuilt_root = os.path.expanduser(
+            config.get("markupserve", "prebuilt_root"))
+        prebuilt_manifest = load_build_manifest(prebuilt_root)
+
+        print("Loaded %d prebuilt pages from '%s'" % (
+            len(prebuilt_manifest), prebuilt_root))
+
+    slow_request_threshold = config.getfloat(
+        "markupserve", "slow_request_threshold", fallback=0)
+
+    index_rendered_text = config.getboolean(
+        "markupserve", "index_rendered_text", fallback=False)
+
+    index_job = IndexJob()
+    index_write_lock = threading.Lock()
+    render_flights = SingleFlight()
+    search_cache = SearchCache(config.getint(
+        "markupserve", "search_cache_size",
+        fallback=DEFAULT_SEARCH_CACHE_SIZE))
+
+    # The index itself is opened in the background by open_index once the
+    # server has started
+    if config.has_option("markupserve", "index_root"):
+        index_root = os.path.expanduser(config.get("markupserve",
+                                                   "index_root"))
+
+        watch_interval = config.getfloat("markupserve", "watch_interval",
+                                         fallback=0)
+
+        if watch_interval > 0:
+            document_root = os.path.expanduser(config.get(
+                "markupserve", "document_root"))
+
+            print("Watching '%s' for changes every %s seconds" % (
+                document_root, watch_interval))
+
+            index_watcher = IndexWatcher(
+                document_root, watch_interval,
+                config.getfloat("markupserve", "watch_debounce",
+                                fallback=DEFAULT_WATCH_DEBOUNCE),
+                config.getint("markupserve", "watch_batch_size",
+                              fallback=DEFAULT_WATCH_BATCH_SIZE))
+
+
+def wsgi_get(url, headers=None):
+    """
+    Requests url from MarkupServe in-process, without going through a
+    server. Returns the response's status code, headers and body.
+    """
+    environ = {}
+    wsgiref.util.setup_testing_defaults(environ)
+
+    (path, _, query_string) = url.partition("?")
+
+    # WSGI passes paths as latin-1 decoded bytes
+    environ["PATH_INFO"] = path.encode("utf-8").decode("latin-1")
+    environ["QUERY_STRING"] = query_string
+    environ[IN_PROCESS_ENVIRON_KEY] = True
+
+    for name, value in (headers or {}).items():
+        environ["HTTP_" + name.upper().replace("-", "_")] = value
+
+    start = {}
+
+    def start_response(status, response_headers, exc_info=None):
+        start["status"] = int(status.split()[0])
+        start["headers"] = bottle.HeaderDict(response_headers)
+
+    body = bottle.default_app()(environ, start_response)
+
+    try:
+        body = b"".join(body)
+    finally:
+        if hasattr(body, "close"):
+            body.close()
+
+    return (start["status"], start["headers"], body)
+
+
+def site_pages(document_root, path=None):
+    """
+    Yields the path, relative to document_root, of each visible directory and
+    markup file under it, and whether it's a directory
+    """
+    if path is None:
+        path = document_root
+
+    yield (os.path.relpath(path, document_root), True)
+
+    for entry in list_directory(path)["entries"]:
+        entry_path = os.path.join(path, entry["name"])
+
+        if entry["is_dir"]:
+            for page in site_pages(document_root, entry_path):
+                yield page
+        elif os.path.splitext(entry["name"])[1] in markup_file_suffixes:
+            yield (os.path.relpath(entry_path, document_root), False)
+
+
+def build_page(relative_path, is_dir, out_root, etag):
+    """
+    Renders the page for a document or directory to out_root, unless the page
+    there was built from the same inputs as the current page (has the given
+    ETag). Returns the page's ETag and whether it was rendered; the ETag is
+    None if the page couldn't be rendered or can't be cached.
+    """
+    if relative_path == os.curdir:
+        url = "/view/"
+    else:
+        url = "/view/" + relative_path
+
+    page_path = prebuilt_page_path(out_root, relative_path, is_dir)
+
+    headers = {}
+
+    if etag is not None and os.path.exists(page_path):
+        headers["If-None-Match"] = '"%s"' % (etag)
+
+    (status, response_headers, body) = wsgi_get(url, headers)
+
+    if status == 304:
+        return (etag, False)
+
+    if status != 200:
+        print("Can't render '%s' (status %d)" % (relative_path, status))
+        return (None, False)
+
+    os.makedirs(os.path.dirname(page_path), exist_ok=True)
+
+    temp_path = "%s.%d.tmp" % (page_path, os.getpid())
+
+    with open(temp_path, "wb") as fp:
+        fp.write(body)
+
+    os.replace(temp_path, page_path)
+
+    etag = response_headers.get("ETag")
+
+    if etag is None:
+        # Pages that can't be cached aren't recorded in the manifest, so
+        # they're rebuilt every time
+        return (None, True)
+
+    return (etag.strip('"'), True)
+
+
+def build_site(out_root, jobs):
+    """
+    Renders every directory listing, calendar and markup file under
+    document_root to static pages in out_root, using jobs processes. Pages
+    whose inputs haven't changed since the last build are left alone.
+    """
+    document_root = os.path.expanduser(config.get(
+        "markupserve", "document_root"))
+
+    start_time = time.time()
+    old_manifest = load_build_manifest(out_root)
+    pages = list(site_pages(document_root))
+
+    arguments = ([relative_path for (relative_path, _) in pages],
+                 [is_dir for (_, is_dir) in pages],
+                 itertools.repeat(out_root),
+                 [old_manifest.get(relative_path, {}).get("etag")
+                  for (relative_path, _) in pages])
+
+    print("Building %d pages in '%s' with %d processes ..." % (
+        len(pages), out_root, jobs))
+
+    if jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            results = list(executor.map(build_page, *arguments,
+                                        chunksize=16))
+    else:
+        results = list(map(build_page, *arguments))
+
+    manifest = {}
+    rendered = 0
+    failed = 0
+
+    for ((relative_path, is_dir), (etag, page_rendered)) in zip(pages,
+                                                                 results):
+        if etag is not None:
+            manifest[relative_path] = {"etag": etag, "is_dir": is_dir}
+        elif not page_rendered:
+            failed += 1
+
+        rendered += page_rendered
+
+    removed = 0
+
+    for (relative_path, built_page) in old_manifest.items():
+        if relative_path not in manifest:
+            try:
+                os.remove(prebuilt_page_path(out_root, relative_path,
+                                             built_page["is_dir"]))
+                removed += 1
+            except OSError:
+                pass
+
+    shutil.copytree(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 "static"),
+                    os.path.join(out_root, "static"), dirs_exist_ok=True)
+
+    manifest_path = os.path.join(out_root, BUILD_MANIFEST_FILE_NAME)
+
+    with open(manifest_path + ".tmp", "w") as fp:
+        json.dump(manifest, fp)
 
+    os.replace(manifest_path + ".tmp", manifest_path)
 
-parser = argparse.ArgumentParser(
-    description="serves a directory hierarchy of documents written in a "
-    "markup language using on-the-fly conversion")
-parser.add_argument("-c", "--config", default="config.cfg",
-                    help="file containing information about markupserve's "
-                    "configuration")
+    print("Rendered %d pages, %d unchanged, %d removed, %d failed in %.2fs" % (
+        rendered, len(pages) - rendered - failed, removed, failed,
+        time.time() - start_time))
 
-args = parser.parse_args()
 
-if not os.path.exists(args.config):
-    exit("Can't find config file '%s'" % (args.config))
+class ThreadPoolWSGIServer(wsgiref.simple_server.WSGIServer):
+    """
+    A WSGI server that handles requests on a fixed-size pool of threads,
+    accepting connections on an already-bound listening socket
+    """
+
+    def __init__(self, listen_socket, threads):
+        wsgiref.simple_server.WSGIServer.__init__(
+            self, listen_socket.getsockname(),
+            wsgiref.simple_server.WSGIRequestHandler, bind_and_activate=False)
+
+        self.socket.close()
+        self.socket = listen_socket
+
+        (host, port) = self.server_address[:2]
+        self.server_name = host
+        self.server_port = port
+        self.setup_environ()
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request,
+                             client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def run_prefork_worker(listen_socket, worker_number, threads):
+    if index_root is not None:
+        # Only one worker creates the index and watches the document root
+        # for changes
+        index_job.start("open", functools.partial(
+            open_index, primary=(worker_number == 0)))
+
+    server = ThreadPoolWSGIServer(listen_socket, threads)
+    server.set_app(bottle.default_app())
+
+    print("Worker %d (pid %d) serving with %d threads" % (
+        worker_number, os.getpid(), threads))
+
+    server.serve_forever()
+
+
+def serve_prefork(hostname, port, workers, threads):
+    """
+    Serves requests from several forked worker processes that share one
+    listening socket. Workers that exit are replaced until the server is
+    interrupted.
+    """
+    global index_ready_event
+
+    listen_socket = socket.create_server((hostname, port), backlog=128)
+    children = {}
+
+    index_ready_event = multiprocessing.Event()
+
+    def start_worker(worker_number):
+        pid = os.fork()
+
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            run_prefork_worker(listen_socket, worker_number, threads)
+            sys.exit(0)
+
+        children[pid] = worker_number
+
+    def stop_workers(signum, frame):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+        for pid in list(children):
+            os.kill(pid, signal.SIGTERM)
+
+        sys.exit(0)
+
+    print("Listening on http://%s:%d/ with %d workers" % (hostname, port,
+                                                          workers))
+
+    for worker_number in range(workers):
+        start_worker(worker_number)
+
+    signal.signal(signal.SIGINT, stop_workers)
+    signal.signal(signal.SIGTERM, stop_workers)
+
+    while True:
+        (pid, status) = os.wait()
+        worker_number = children.pop(pid, None)
+
+        if worker_number is not None:
+            print("Worker %d (pid %d) exited with status %d; restarting it"
+                  % (worker_number, pid, status))
+            start_worker(worker_number)
+
+
+def server_thread_options(server, threads):
+    """
+    Returns the options to pass to bottle's adapter for server to have it
+    handle requests on the given number of threads
+    """
+    if server == "paste":
+        # Paste requires its idle thread target to be below the pool size
+        return {
+            "threadpool_workers": threads,
+            "threadpool_options": {"spawn_if_under": min(5, threads - 1)}
+            }
+    elif server == "waitress":
+        return {"threads": threads}
+    elif server == "cheroot":
+        return {"numthreads": threads}
+    else:
+        return {}
+
+
+def serve(config):
+    hostname = config.get("markupserve", "hostname", fallback="localhost")
+    workers = config.getint("markupserve", "workers", fallback=1)
+    threads = config.getint("markupserve", "threads",
+                            fallback=DEFAULT_SERVER_THREADS)
+
+    if workers > 1:
+        serve_prefork(hostname, port, workers, threads)
+        return
+
+    server = config.get("markupserve", "server", fallback=DEFAULT_SERVER)
+
+    if index_root is not None:
+        index_job.start("open", open_index)
+
+    run(host=hostname, port=port, server=server,
+        **server_thread_options(server, threads))
+
+
+def read_config(config_path):
+    if not os.path.exists(config_path):
+        exit("Can't find config file '%s'" % (config_path))
+
+    with open(config_path, 'r') as fp:
+        config.readfp(fp)
+
+
+def create_app(config_path):
+    """
+    Reads the config file at config_path and returns markupserve's WSGI
+    application, for serving with a WSGI server other than bottle's built-in
+    ones (e.g. gunicorn). The index is opened in the background, as it is by
+    serve().
+    """
+    read_config(config_path)
+    parse_config(config)
+
+    debug(config.getboolean("markupserve", "debug", fallback=False))
+
+    if index_root is not None:
+        index_job.start("open", open_index)
+
+    return bottle.default_app()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="serves a directory hierarchy of documents written in a "
+        "markup language using on-the-fly conversion")
+    parser.add_argument("-c", "--config", default="config.cfg",
+                        help="file containing information about "
+                        "markupserve's configuration")
+
+    subparsers = parser.add_subparsers(dest="command")
 
-with open(args.config, 'r') as fp:
-    config.readfp(fp)
+    build_parser = subparsers.add_parser(
+        "build", help="render every document, directory listing and "
+        "calendar to static pages instead of serving them")
+    build_parser.add_argument("--out", help="directory to write pages to "
+                              "(defaults to the configured prebuilt_root)")
+    build_parser.add_argument("-j", "--jobs", type=int,
+                              default=os.cpu_count(),
+                              help="number of processes to render pages "
+                              "with")
 
-parse_config(config)
+    args = parser.parse_args()
+
+    read_config(args.config)
+
+    if config.get("markupserve", "server",
+                  fallback=DEFAULT_SERVER) == "gevent":
+        # gevent has to patch the standard library before any threads or
+        # locks are created
+        from gevent import monkey
+        monkey.patch_all()
+
+    parse_config(config)
+
+    debug(config.getboolean("markupserve", "debug", fallback=False))
+
+    if args.command == "build":
+        if args.out is not None:
+            build_root = args.out
+        elif prebuilt_root is not None:
+            build_root = prebuilt_root
+        else:
+            exit("Must give --out or configure 'prebuilt_root' to build")
+
+        build_site(os.path.expanduser(build_root), max(args.jobs, 1))
+    else:
+        serve(config)
 
-debug(True)
 
-run(host=config.get('markupserve', 'hostname', fallback='localhost'),
-    port=port,
-    server="paste")
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,200 @@
 #!/usr/bin/env python
 
+import os
 import sys
+import struct
+import traceback
 import unicodedata
+import functools
+import hashlib
+import threading
 
 import misaka as m
 import houdini as h
+import pygments
 from pygments import highlight
 from pygments.lexers import get_lexer_by_name
+from pygments.lexers.special import TextLexer
 from pygments.formatters import HtmlFormatter
+from pygments.util import ClassNotFound
 
-formatter = HtmlFormatter(style='friendly')
+# Passing this flag runs the renderer as a long-lived worker that renders one
+# document per request read from stdin; see daemon()
+DAEMON_FLAG = "--daemon"
+DAEMON_HANDSHAKE = b"markupserve-renderer 1\n"
+
+# Passing this flag renders every path given after it (or, if there are
+# none, listed one per line on stdin) in a single run; see batch()
+BATCH_FLAG = "--batch"
+
+# Passing this flag prints the stylesheet for highlighted code, which
+# MarkupServe serves from static/ rather than it being included in every
+# document
+CSS_FLAG = "--css"
+
+STYLE = "friendly"
+STYLESHEET_LINK = ('<link rel="stylesheet" href="/static/pygments-%s.css" '
+                   'type="text/css"/>\n' % (STYLE))
+
+# Highlighted code blocks are cached in this directory (set it to an empty
+# string to disable the cache), up to this many bytes
+HIGHLIGHT_CACHE_ROOT = os.environ.get(
+    "MARKUPSERVE_HIGHLIGHT_CACHE",
+    os.path.join(os.environ.get("XDG_CACHE_HOME",
+                                os.path.expanduser("~/.cache")),
+                 "markupserve", "highlight"))
+HIGHLIGHT_CACHE_SIZE = int(os.environ.get(
+    "MARKUPSERVE_HIGHLIGHT_CACHE_SIZE", 32 * 2**20))
+
+formatter = HtmlFormatter(style=STYLE)
+
+
+class HighlightCache(object):
+    """
+    Caches highlighted code blocks on disk, so that snippets repeated across
+    documents (and renders) are highlighted once. Each entry is a file whose
+    first line is the entry's key.
+
+    Entries are spread evenly over DIRECTORIES directories by the hash of
+    their keys. Once a directory's entries take up more than its share of
+    max_bytes, its least recently used entries are removed, so that adding an
+    entry only has to look at the directory it's added to rather than at the
+    whole cache.
+    """
+
+    DIRECTORIES = 256
+
+    def __init__(self, cache_root, max_bytes):
+        self.cache_root = cache_root
+        self.max_directory_bytes = max_bytes / self.DIRECTORIES
+
+    def disk_path(self, key):
+        key_hash = hashlib.sha1(key).hexdigest()
+        return os.path.join(self.cache_root, key_hash[:2], key_hash)
+
+    def get(self, key):
+        path = self.disk_path(key)
+
+        try:
+            with open(path, 'rb') as fp:
+                stored_key = fp.readline()
+                output = fp.read()
+
+            # Mark the entry as recently used
+            os.utime(path)
+        except OSError:
+            return None
+
+        if stored_key != key + b"\n":
+            return None
+
+        return output.decode("utf-8")
+
+    def put(self, key, output):
+        path = self.disk_path(key)
+        temp_path = "%s.%d.%d" % (path, os.getpid(), threading.get_ident())
+        data = key + b"\n" + output.encode("utf-8")
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            with open(temp_path, 'wb') as fp:
+                fp.write(data)
+
+            os.replace(temp_path, path)
+        except OSError:
+            return
+
+        self.evict(os.path.dirname(path))
+
+    def evict(self, directory):
+        entries = []
+
+        try:
+            with os.scandir(directory) as directory_entries:
+                for entry in directory_entries:
+                    # Skip other writers' temporary files
+                    if "." in entry.name:
+                        continue
+
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            return
+
+        directory_bytes = sum(size for (_, size, _) in entries)
+
+        if directory_bytes <= self.max_directory_bytes:
+            return
+
+        # Make some room, so that eviction doesn't happen on every put
+        for (_, size, path) in sorted(entries):
+            if directory_bytes <= self.max_directory_bytes * 0.9:
+                break
+
+            try:
+                os.remove(path)
+                directory_bytes -= size
+            except OSError:
+                pass
+
+
+if len(HIGHLIGHT_CACHE_ROOT) > 0 and HIGHLIGHT_CACHE_SIZE > 0:
+    highlight_cache = HighlightCache(HIGHLIGHT_CACHE_ROOT,
+                                     HIGHLIGHT_CACHE_SIZE)
+else:
+    highlight_cache = None
+
+
+@functools.lru_cache(maxsize=None)
+def lexer_for_language(lang):
+    try:
+        return get_lexer_by_name(lang, stripall=True)
+    except ClassNotFound:
+        return None
+
+
+def highlight_code(text, lang):
+    key = "%s\0%s\0%s\0%s" % (
+        lang, hashlib.sha1(text.encode("utf-8")).hexdigest(), STYLE,
+        pygments.__version__)
+    key = key.encode("utf-8")
+
+    if highlight_cache is not None:
+        output = highlight_cache.get(key)
+
+        if output is not None:
+            return output
+
+    output = ''
+    lexer = lexer_for_language(lang)
+
+    if lexer is None:
+        output += '<b>Language "' + h.escape_html(lang) + '" not supported</b>'
+        lexer = TextLexer(stripall=True)
+
+    output += highlight(text, lexer, formatter)
+
+    if highlight_cache is not None:
+        highlight_cache.put(key, output)
+
+    return output
 
 
 # Create a custom renderer
 class HighlightingRenderer(m.HtmlRenderer):
-    def block_code(self, text, lang):
+    def blockcode(self, text, lang):
         text = m.smartypants(text)
 
-        output = ''
-
         if not lang:
             return '\n<pre><code>%s</code></pre>\n' % \
                 h.escape_html(text.strip())
 
-        try:
-            lexer = get_lexer_by_name(lang, stripall=True)
-        except:
-            output += '<b>Language "' + lang + '" not supported</b>'
-            lexer = get_lexer_by_name(text, stripall=True)
-
-        output += highlight(text, lexer, formatter)
-
-        return output
+        return highlight_code(text, lang)
 
 # And use the renderer
 renderer = HighlightingRenderer(flags=m.HTML_HARD_WRAP | m.HTML_USE_XHTML)
@@ -41,10 +204,84 @@ md = m.Markdown(renderer,
                 m.EXT_TABLES | m.EXT_NO_INTRA_EMPHASIS | m.EXT_AUTOLINK |
                 m.EXT_STRIKETHROUGH | m.EXT_SUPERSCRIPT)
 
-with open(sys.argv[1], 'r') as fp:
-    file_contents = fp.read()
-    file_contents = unicodedata.normalize('NFKD', file_contents)
 
-    print(('<style>\n' + formatter.get_style_defs() + '</style>'))
+def render_contents(file_contents):
+    """
+    Renders a Markdown document, given as bytes, to HTML. MarkupServe can call
+    this in-process instead of running this script; see its 'module' option.
+    """
+    file_contents = unicodedata.normalize('NFKD', file_contents.decode("utf-8"))
+
+    return STYLESHEET_LINK + md(file_contents) + '\n'
+
+
+def render(path):
+    with open(path, 'rb') as fp:
+        return render_contents(fp.read())
+
+
+def write_response(stdout, path):
+    """
+    Renders path, writing a 1-byte status (0 on success) and a 4-byte
+    big-endian length, followed by that many bytes of rendered HTML (or of an
+    error message if the status is non-zero)
+    """
+    try:
+        status, output = 0, render(path).encode("utf-8")
+    except Exception:
+        status, output = 1, traceback.format_exc().encode("utf-8")
+
+    stdout.write(struct.pack(">BI", status, len(output)))
+    stdout.write(output)
+    stdout.flush()
+
+
+def daemon(stdin, stdout):
+    """
+    Renders documents until stdin is closed.
+
+    Each request is a 4-byte big-endian length followed by that many bytes of
+    UTF-8 encoded path, and is answered with a response as described in
+    write_response().
+    """
+    stdout.write(DAEMON_HANDSHAKE)
+    stdout.flush()
+
+    while True:
+        header = stdin.read(4)
+
+        if len(header) < 4:
+            return
+
+        (length,) = struct.unpack(">I", header)
+        path = stdin.read(length).decode("utf-8")
+
+        write_response(stdout, path)
+
+
+def batch(paths, stdin, stdout):
+    """
+    Renders each of paths in turn, writing the same handshake and responses
+    as daemon() does. If paths is empty, they're read from stdin, one per
+    line; the whole list is read before anything is rendered, so the caller
+    can write it all before reading any responses.
+    """
+    stdout.write(DAEMON_HANDSHAKE)
+    stdout.flush()
+
+    if len(paths) == 0:
+        paths = stdin.read().decode("utf-8").splitlines()
+
+    for path in paths:
+        write_response(stdout, path)
+
 
-    print((md(file_contents)))
+if __name__ == "__main__":
+    if sys.argv[1] == DAEMON_FLAG:
+        daemon(sys.stdin.buffer, sys.stdout.buffer)
+    elif sys.argv[1] == BATCH_FLAG:
+        batch(sys.argv[2:], sys.stdin.buffer, sys.stdout.buffer)
+    elif sys.argv[1] == CSS_FLAG:
+        sys.stdout.write(formatter.get_style_defs())
+    else:
+        sys.stdout.write(render(sys.argv[1]))